@@ -0,0 +1,298 @@
+"""基准测试：用 flask forge --count 生成不同规模的数据，测量主要页面的响应时间。
+
+每个数据规模在单独的子进程中运行，分别记录峰值内存（RSS），驱动方式有两种：
+testclient（Flask 测试客户端，不经过网络）和 wsgi（本地 werkzeug WSGI 服务器 + HTTP 请求）。
+
+    python benchmark.py --sizes 1000,100000 --requests 200 --output results.json
+    python benchmark.py --sizes 1000 --baseline results.json   # 与基准结果比较，p95 变慢超过阈值时返回 1
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from werkzeug.serving import make_server
+
+from watchlist import create_app, db
+from watchlist.models import Movie
+
+SCENARIOS = ('login', 'index', 'edit', 'create', 'delete')
+DRIVERS = ('testclient', 'wsgi')
+USERNAME = PASSWORD = 'bench'
+
+
+class TestClientDriver(object):
+    """通过 Flask 测试客户端发送请求"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class WSGIDriver(object):
+    """在后台线程中启动本地 WSGI 服务器，通过 HTTP 发送请求，自己保存会话 cookie"""
+
+    def __init__(self, app):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # 不输出每个请求的访问日志
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.cookies = SimpleCookie()
+
+    def request(self, method, path, data=None):
+        headers = {}
+        body = None
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % (k, v.value) for k, v in self.cookies.items())
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            for header in response.msg.get_all('Set-Cookie') or ():
+                self.cookies.load(header)
+            return response.status
+        finally:
+            connection.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+drivers = {
+    'testclient': TestClientDriver,
+    'wsgi': WSGIDriver,
+}
+
+
+def percentile(sorted_values, p):
+    """最近秩法（nearest-rank）计算百分位数"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    values = sorted(latencies)
+    return {
+        'requests': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'throughput_rps': round(len(values) / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def run_scenario(app, driver, scenario, size, count, rand):
+    """依次发送 count 个请求，返回每个请求的耗时（秒）和总耗时。
+
+    写操作会产生闪现消息，每次写操作之后不计时地请求一次设置页面把它们取出，
+    避免会话 cookie 越来越大影响后面的请求。
+    """
+    if scenario == 'delete':
+        with app.app_context():
+            ids = [movie_id for movie_id, in db.session.query(Movie.id).order_by(Movie.id.desc()).limit(count)]
+        requests = [('POST', '/movie/delete/%d' % movie_id, None) for movie_id in ids]
+    elif scenario == 'create':
+        requests = [('POST', '/', {'title': 'Benchmark %d' % i, 'year': str(rand.randint(1920, 2025))})
+                    for i in range(count)]
+    elif scenario == 'login':
+        requests = [('POST', '/login', {'username': USERNAME, 'password': PASSWORD})] * count
+    elif scenario == 'edit':
+        requests = [('GET', '/movie/edit/%d' % rand.randint(1, size), None) for _ in range(count)]
+    else:
+        requests = [('GET', '/', None)] * count
+
+    latencies = []
+    elapsed = 0.0
+    for method, path, data in requests:
+        started_at = time.perf_counter()
+        status = driver.request(method, path, data)
+        latency = time.perf_counter() - started_at
+        if status >= 400:
+            raise RuntimeError('%s %s returned %d' % (method, path, status))
+        latencies.append(latency)
+        elapsed += latency
+        if method == 'POST':
+            driver.request('GET', '/settings')
+    return latencies, elapsed
+
+
+def run_size(size, args):
+    """在当前进程中为一个数据规模建库、生成数据并运行所有场景"""
+    directory = tempfile.mkdtemp(prefix='watchlist-bench-')
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'bench.sqlite3'),
+        'PAGE_CACHE_TYPE': args.page_cache,
+        'PAGE_CACHE_DIR': os.path.join(directory, 'page-cache'),
+        'LOGIN_THROTTLE_BURST': 0,  # login 场景从同一个地址反复登录
+        'WRITE_QUEUE_ENABLED': args.write_queue != 'off',
+        'WRITE_QUEUE_ACK': args.write_queue if args.write_queue != 'off' else 'commit',
+    })
+    runner = app.test_cli_runner()
+    started_at = time.perf_counter()
+    for command in (['initdb'], ['forge', '--count', str(size), '--seed', str(args.seed)],
+                    ['admin', '--username', USERNAME, '--password', PASSWORD]):
+        result = runner.invoke(args=command)
+        if result.exit_code != 0:
+            raise RuntimeError('flask %s failed: %s' % (' '.join(command), result.output))
+    seed_seconds = time.perf_counter() - started_at
+
+    results = []
+    for name in args.drivers:
+        driver = drivers[name](app)
+        try:
+            rand = random.Random(args.seed)
+            for scenario in args.scenarios:
+                if scenario != 'login' and scenario != 'index':
+                    driver.request('POST', '/login', {'username': USERNAME, 'password': PASSWORD})
+                    driver.request('GET', '/settings')
+                elif scenario == 'index':
+                    driver.request('GET', '/logout')  # 主页按未登录用户测量，会用到页面缓存
+                for _ in range(args.warmup):
+                    driver.request('GET', '/')
+                latencies, elapsed = run_scenario(app, driver, scenario, size, args.requests, rand)
+                result = {'size': size, 'driver': name, 'scenario': scenario}
+                result.update(summarize(latencies, elapsed))
+                results.append(result)
+        finally:
+            driver.close()
+
+    # ru_maxrss 在 Linux 上的单位是 KiB，在 macOS 上是字节
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_kb = peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+    for result in results:
+        result['peak_rss_kb'] = peak_rss_kb
+        result['seed_seconds'] = round(seed_seconds, 3)
+    return results
+
+
+def run_all(args):
+    """每个数据规模在新的子进程中运行，峰值内存互不影响"""
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--run-size', str(size),
+                   '--requests', str(args.requests), '--warmup', str(args.warmup), '--seed', str(args.seed),
+                   '--drivers', ','.join(args.drivers), '--scenarios', ','.join(args.scenarios),
+                   '--page-cache', args.page_cache, '--write-queue', args.write_queue]
+        print('Running %d movies ...' % size, file=sys.stderr)
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.extend(json.loads(output))
+    return {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'requests': args.requests,
+            'page_cache': args.page_cache,
+            'write_queue': args.write_queue,
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """按 (规模, 驱动, 场景) 比较 p95，返回变慢超过 tolerance 的条目"""
+    old = {(r['size'], r['driver'], r['scenario']): r for r in baseline['results']}
+    regressions = []
+    print('%-8s %-10s %-8s %10s %10s %8s' % ('size', 'driver', 'scenario', 'base p95', 'p95', 'change'))
+    for result in report['results']:
+        key = (result['size'], result['driver'], result['scenario'])
+        if key not in old or not old[key]['p95_ms']:
+            continue
+        change = result['p95_ms'] / old[key]['p95_ms'] - 1
+        print('%-8d %-10s %-8s %9.2fms %9.2fms %+7.0f%%'
+              % (key + (old[key]['p95_ms'], result['p95_ms'], change * 100)))
+        if change > tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def print_report(report):
+    print('%-8s %-10s %-8s %9s %9s %9s %10s %10s'
+          % ('size', 'driver', 'scenario', 'p50', 'p95', 'p99', 'req/s', 'peak RSS'))
+    for r in report['results']:
+        print('%-8d %-10s %-8s %7.2fms %7.2fms %7.2fms %10.1f %8.1fMB'
+              % (r['size'], r['driver'], r['scenario'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+                 r['throughput_rps'], r['peak_rss_kb'] / 1024))
+
+
+def comma_list(choices=None, type=str):
+    def parse(value):
+        items = [type(item) for item in value.split(',') if item]
+        for item in items:
+            if choices is not None and item not in choices:
+                raise argparse.ArgumentTypeError('invalid choice: %r (choose from %s)' % (item, ', '.join(choices)))
+        return items
+    return parse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the watchlist app against generated data.')
+    parser.add_argument('--sizes', type=comma_list(type=int), default=[1000],
+                        help='Comma separated numbers of movies, e.g. 1000,100000,1000000 (default: 1000).')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario (default: 200).')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests before each scenario.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for forge and the request mix (default: 0).')
+    parser.add_argument('--drivers', type=comma_list(DRIVERS), default=list(DRIVERS))
+    parser.add_argument('--scenarios', type=comma_list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--page-cache', choices=('null', 'lru', 'filesystem'), default='null',
+                        help='PAGE_CACHE_TYPE used by the app (default: null).')
+    parser.add_argument('--write-queue', choices=('off', 'commit', 'queued'), default='off',
+                        help='Send form writes through the group-commit write queue with this ack mode.')
+    parser.add_argument('--output', help='Write the JSON report to this file.')
+    parser.add_argument('--baseline', help='Compare p95 latencies against a previous JSON report.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed p95 slowdown against the baseline (default: 0.2, i.e. 20%%).')
+    parser.add_argument('--run-size', type=int, help=argparse.SUPPRESS)  # 子进程内部使用
+    args = parser.parse_args(argv)
+
+    if args.run_size is not None:
+        json.dump(run_size(args.run_size, args), sys.stdout)
+        return 0
+
+    report = run_all(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print('%d scenarios are more than %.0f%% slower than the baseline.'
+                  % (len(regressions), args.tolerance * 100), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,33 @@
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 #from app import app, db, Movie, User, forge, initdb
-from watchlist import app, db
+from flask import g
+from sqlalchemy import event, text
+from sqlalchemy.pool import QueuePool
+from werkzeug.security import generate_password_hash
+
+from watchlist import app_extension, create_app, db
+from watchlist.assets import init_assets
+from watchlist.auth import check_and_rehash, hash_pool
+from watchlist.cache import FileSystemCache
 from watchlist.commands import forge, initdb
-from watchlist.models import User, Movie
+from watchlist.compression import compress_chunks
+from watchlist.engine import sqlite_pragmas
+from watchlist.importer import iter_json
+from watchlist.models import User, Movie, create_movie, current_version, update_movie
+from watchlist.stats import year_stats
+from watchlist.writequeue import write_queue
 
 
 class WatchlistTestCase(unittest.TestCase):
@@ -10,33 +35,37 @@ class WatchlistTestCase(unittest.TestCase):
     def setUp(self):
         """准备环境"""
 
-        # 更新配置
-        app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+        # 使用测试配置创建程序实例，并推送程序上下文
+        self.app = create_app('testing')
+        self.context = self.app.app_context()
+        self.context.push()
         # 创建数据库和表
         db.create_all()
         # 创建测试数据：一个用户和一个电影
         user = User(name='Test', username='test')
         user.set_password('123')
-        movie = Movie(title='Test Movie Title', year='2019')
+        movie = Movie(title='Test Movie Title', year='2019', user=user)
         # 一次性添加全部模型类实例，用列表方式传参
         db.session.add_all([user, movie])
         db.session.commit()
+        self.user = user
 
-        self.client = app.test_client()  # 创建测试客户端，模拟浏览器
-        self.runner = app.test_cli_runner()  # 创建测试命令运行器
+        self.client = self.app.test_client()  # 创建测试客户端，模拟浏览器
+        self.runner = self.app.test_cli_runner()  # 创建测试命令运行器
 
     def tearDown(self):
         """销毁环境"""
         db.session.remove()  # 清除数据库会话
         db.drop_all()  # 删除数据库表
+        self.context.pop()
 
     def test_app_exist(self):
         """测试程序实例是否存在"""
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
 
     def test_app_is_testing(self):
         """测试程序是否处于测试模式"""
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
 
     def test_404_page(self):
         """测试404页面"""
@@ -46,6 +75,21 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Go Back', data)
         self.assertEqual(response.status_code, 404)
 
+    def test_error_pages_skip_database(self):
+        """测试错误页面渲染一次后缓存，之后的 404 不访问数据库，修改名字后重新渲染"""
+        self.client.get('/nothing')
+        self.assertEqual(self.count_queries(None, self.client.get, '/nothing/else'), 0)
+
+        self.login()
+        response = self.client.get('/nothing')
+        self.assertIn("Test's Watchlist", response.get_data(as_text=True))
+        self.client.post('/settings', data=dict(name='Grey Li'))
+        data = self.client.get('/nothing').get_data(as_text=True)
+        self.assertIn("Grey Li's Watchlist", data)
+        self.assertIn('Login', data)  # 错误页面按未登录用户渲染
+        # 提示消息留给下一个正常页面
+        self.assertIn('Settings updated.', self.client.get('/').get_data(as_text=True))
+
     def test_index_page(self):
         """测试主页"""
         response = self.client.get('/')
@@ -54,6 +98,281 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Test Movie Title', data)
         self.assertEqual(response.status_code, 200)
 
+    def test_index_pagination(self):
+        """测试主页游标分页"""
+        self.app.config['MOVIES_PER_PAGE'] = 2
+        db.session.add_all([Movie(title='Movie %d' % i, year='2019', user=self.user) for i in range(2, 6)])
+        db.session.commit()
+
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 2', data)
+        self.assertNotIn('Movie 3', data)
+        self.assertIn('/?after=2', data)
+        self.assertNotIn('Prev', data)
+
+        response = self.client.get('/?after=4')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 5', data)
+        self.assertNotIn('Movie 4', data)
+        self.assertNotIn('Next', data)
+        self.assertIn('/?before=5', data)
+
+        response = self.client.get('/?before=5')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 3', data)
+        self.assertIn('Movie 4', data)
+        self.assertNotIn('Movie 5', data)
+        self.assertIn('/?after=4', data)
+        self.assertIn('/?before=3', data)
+
+        # 超出 SQLite 整数范围的游标和无效的游标一样回到第一页
+        for query in ('after=99999999999999999999', 'before=-99999999999999999999'):
+            data = self.client.get('/?' + query).get_data(as_text=True)
+            self.assertIn('Test Movie Title', data)
+            response = self.client.get('/api/movies?' + query)
+            self.assertEqual(response.get_json()['movies'][0]['title'], 'Test Movie Title')
+
+    def test_index_streamed(self):
+        """测试主页流式渲染、标题数来自 COUNT(*) 以及提示消息只显示一次"""
+        self.app.config['MOVIES_PER_PAGE'] = 5
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000 + i, user=self.user) for i in range(11)])
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertTrue(response.is_streamed)
+        data = response.get_data(as_text=True)
+        response.close()
+        self.assertIn('12 Titles', data)
+        self.assertEqual(data.count('<li>Movie'), 5)
+        data = self.client.get('/?year_from=2005').get_data(as_text=True)
+        self.assertIn('7 Titles', data)
+
+        self.client.post('/login', data=dict(username='test', password='123'))
+        self.assertIn('Login success.', self.client.get('/').get_data(as_text=True))
+        self.assertNotIn('Login success.', self.client.get('/').get_data(as_text=True))
+
+    def test_index_filter_and_sort(self):
+        """测试主页按年份筛选和排序"""
+        self.app.config['MOVIES_PER_PAGE'] = 2
+        db.session.add_all([Movie(title=title, year=year, user=self.user) for title, year in
+                            [('Leon', 1994), ('WALL-E', 2008), ('Akira', 1988), ('Mahjong', 1996)]])
+        db.session.commit()
+
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertLess(data.index('Akira'), data.index('Leon'))
+        self.assertNotIn('Mahjong', data)
+        self.assertIn('/?after=2', data)
+
+        data = self.client.get('/?after=2').get_data(as_text=True)
+        self.assertLess(data.index('Mahjong'), data.index('WALL-E'))
+
+        data = self.client.get('/?sort=-year&year_from=1990&year_to=2010').get_data(as_text=True)
+        self.assertLess(data.index('WALL-E'), data.index('Mahjong'))
+        self.assertNotIn('Test Movie Title', data)
+        self.assertIn('after=5', data)
+        self.assertIn('sort=-year', data)
+
+        data = self.client.get('/?sort=-year&year_from=1990&year_to=2010&after=5').get_data(as_text=True)
+        self.assertIn('Leon', data)
+        self.assertNotIn('Akira', data)
+        self.assertNotIn('Next', data)
+
+        data = self.client.get('/?sort=title&before=5').get_data(as_text=True)
+        self.assertIn('Akira', data)
+        self.assertIn('Leon', data)
+        self.assertNotIn('WALL-E', data)
+
+        # 超出年份范围的筛选条件被忽略
+        data = self.client.get('/?year_from=99999999999999999999&year_to=-1').get_data(as_text=True)
+        self.assertIn('5 Titles', data)
+        self.assertIn('name="year_from" value=""', data)
+
+    def test_year_index_used(self):
+        """测试按年份筛选排序时使用复合索引而不是全表扫描"""
+        sql = 'EXPLAIN QUERY PLAN SELECT * FROM movie WHERE user_id = 1 AND year >= 1990 ' \
+              'AND (year, id) > (1994, 2) ORDER BY year, id LIMIT 21'
+        plan = ' '.join(str(row[-1]) for row in db.session.execute(text(sql)))
+        self.assertIn('ix_movie_user_year_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def count_queries(self, table, func, *args, **kwargs):
+        """辅助方法，统计执行 func 期间查询 table 表的 SQL 语句数"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func(*args, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        if table is None:
+            return len(statements)
+        return len([s for s in statements if 'FROM %s' % table in s])
+
+    def test_user_query_once_per_request(self):
+        """测试一个请求只查询一次用户"""
+        self.login()
+        # 测试中的请求共用推送的程序上下文，清除上一个请求留下的缓存；按主键查询时会话中已有的实例也不产生查询
+        g.pop('users', None)
+        g.pop('_login_user', None)
+        db.session.expunge_all()
+        self.assertEqual(self.count_queries('user', lambda: self.client.get('/').get_data()), 1)
+
+    def test_user_cache_ttl(self):
+        """测试进程级用户缓存及其失效"""
+        self.app.config['USER_CACHE_TTL'] = 60
+        self.login()
+        self.client.get('/')
+        self.assertEqual(self.count_queries('user', self.client.get, '/'), 0)
+
+        response = self.client.post('/settings', data=dict(name='Grey Li'), follow_redirects=True)
+        self.assertIn('Grey Li', response.get_data(as_text=True))
+        self.assertEqual(User.query.first().name, 'Grey Li')
+
+        result = self.runner.invoke(args=['admin', '--username', 'Peter', '--password', '456'])
+        self.assertIn('Done.', result.output)
+        response = self.client.post('/login', data=dict(username='Peter', password='456'), follow_redirects=True)
+        self.assertIn('Login success.', response.get_data(as_text=True))
+
+    def test_index_page_cache(self):
+        """测试未登录主页的页面缓存及写操作后的失效"""
+        self.app.config['PAGE_CACHE_TYPE'] = 'lru'
+        self.client.get('/').get_data()  # 流式响应完整发送后才写入缓存
+        # 测试中的请求共用推送的程序上下文，清除上一个请求缓存的用户，命中缓存时也不应该查询用户
+        g.pop('users', None)
+        self.assertEqual(self.count_queries(None, self.client.get, '/'), 0)
+        response = self.client.get('/')
+        g.pop('users', None)
+        headers = {'If-None-Match': response.headers['ETag']}
+        self.assertEqual(self.count_queries(None, self.client.get, '/', headers=headers), 0)
+
+        self.login()
+        self.client.post('/', data=dict(title='Cached Movie', year='2020'))
+        self.client.get('/logout')
+        self.client.get('/')  # 消费掉 Goodbye. 提示消息
+        response = self.client.get('/')
+        self.assertIn('Cached Movie', response.get_data(as_text=True))
+
+        result = self.runner.invoke(initdb, ['--drop'])
+        self.assertIn('Initialized database.', result.output)
+        response = self.client.get('/')
+        self.assertNotIn('Cached Movie', response.get_data(as_text=True))
+
+    def test_search(self):
+        """测试全文搜索及索引同步"""
+        db.session.add_all([Movie(title='My Neighbor Totoro', year='1988', user=self.user),
+                            Movie(title='Leon', year='1994', user=self.user)])
+        db.session.commit()
+
+        data = self.client.get('/search?q=toto').get_data(as_text=True)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertNotIn('Leon', data)
+        data = self.client.get('/search?q=%22neigh%22 tot(').get_data(as_text=True)
+        self.assertIn('My Neighbor Totoro', data)
+        data = self.client.get('/search?q=nothing').get_data(as_text=True)
+        self.assertIn('No movies found.', data)
+        response = self.client.get('/search?q=toto&page=99999999999999999999')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('No movies found.', response.get_data(as_text=True))
+
+        self.login()
+        self.client.post('/movie/edit/2', data=dict(title='Spirited Away', year='2001'))
+        self.client.post('/movie/delete/3')
+        data = self.client.get('/search?q=spirit').get_data(as_text=True)
+        self.assertIn('Spirited Away', data)
+        self.assertNotIn('Leon', self.client.get('/search?q=leon').get_data(as_text=True))
+        self.assertNotIn('Totoro', self.client.get('/search?q=totoro').get_data(as_text=True))
+
+    def test_reindex_command(self):
+        """测试重建全文索引"""
+        db.session.execute(text("INSERT INTO movie_fts(movie_fts) VALUES ('delete-all')"))
+        db.session.commit()
+        self.assertNotIn('Test Movie Title', self.client.get('/search?q=test').get_data(as_text=True))
+        result = self.runner.invoke(args=['reindex'])
+        self.assertIn('Indexed 1 movies', result.output)
+        self.assertIn('Test Movie Title', self.client.get('/search?q=test').get_data(as_text=True))
+
+    def test_conditional_get(self):
+        """测试基于数据版本号的 ETag 和 304 响应"""
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        self.assertIsNone(response.last_modified)  # 还没有发生过写操作
+        self.assertEqual(self.client.get('/').headers['ETag'], etag)
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(as_text=True), '')
+        self.assertEqual(self.count_queries('movie', self.client.get, '/', headers={'If-None-Match': etag}), 0)
+
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2019'))
+        self.client.get('/logout')
+        self.client.get('/')
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        response = self.client.get('/', headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+        # 页面缓存命中时同样支持条件请求
+        self.app.config['PAGE_CACHE_TYPE'] = 'lru'
+        etag = self.client.get('/').headers['ETag']
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_conditional_get_edit_page(self):
+        """测试编辑页面的条件请求"""
+        self.login()
+        response = self.client.get('/movie/edit/1')
+        etag = response.headers['ETag']
+        response = self.client.get('/movie/edit/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.client.post('/movie/edit/1', data=dict(title='Edited', year='2019'))
+        self.client.get('/')
+        response = self.client.get('/movie/edit/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Edited', response.get_data(as_text=True))
+
+    def test_filesystem_cache(self):
+        """测试文件系统缓存后端"""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileSystemCache(directory, threshold=2)
+            self.assertIsNone(cache.get('a'))
+            cache.set('a', 'page a')
+            self.assertEqual(cache.get('a'), 'page a')
+            self.assertEqual(FileSystemCache(directory).get('a'), 'page a')  # 其他进程可以读到
+            cache.set('b', 'page b')
+            cache.set('c', 'page c')
+            self.assertEqual(len(os.listdir(directory)), 2)
+            cache.clear()
+            self.assertIsNone(cache.get('c'))
+
+    def test_app_extension(self):
+        """测试多个线程同时第一次访问时只创建一个扩展对象"""
+        created = []
+        results = []
+
+        def factory(app):
+            created.append(app)
+            time.sleep(0.05)  # 让其他线程在创建期间到达
+            return object()
+
+        def worker():
+            with self.app.app_context():
+                results.append(app_extension('test_extension', factory))
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(created, [self.app])
+        self.assertEqual(len(set(map(id, results))), 1)
+        self.assertIs(app_extension('test_extension', factory), results[0])
+
     def login(self):
         """辅助方法，用于登录用户"""
         self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
@@ -79,6 +398,10 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Item created', data)
         self.assertIn('Invalid input', data)
 
+        # 测试创建电影条目操作，但年份是 int() 无法转换的 Unicode 数字
+        response = self.client.post('/', data=dict(title='New Movie', year='²'), follow_redirects=True)
+        self.assertIn('Invalid input', response.get_data(as_text=True))
+
     def test_update_item(self):
         """测试更新电影条目"""
         self.login()
@@ -112,13 +435,293 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Item Deleted.', data)
         self.assertNotIn('Test Movie Title', data)
 
+    def test_user_watchlists(self):
+        """测试多用户：每个用户有自己的清单，只能修改自己的电影"""
+        result = self.runner.invoke(args=['user-add', '--username', 'bob', '--password', '456', '--name', 'Bob'])
+        self.assertIn('/user/bob', result.output)
+        result = self.runner.invoke(args=['user-add', '--username', 'bob', '--password', '456'])
+        self.assertIn('User bob already exists.', result.output)
+        bob = User.query.filter_by(username='bob').first()
+        db.session.add(Movie(title='Bob Movie', year='2001', user=bob))
+        db.session.commit()
+
+        data = self.client.get('/user/bob').get_data(as_text=True)
+        self.assertIn("Bob's Watchlist", data)
+        self.assertIn('Bob Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertIn('1 Titles', data)
+        self.assertEqual(self.client.get('/user/nobody').status_code, 404)
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Bob Movie', data)
+
+        self.login()
+        data = self.client.get('/user/bob').get_data(as_text=True)
+        self.assertNotIn('/movie/edit/2', data)
+        self.assertNotIn('<form method="post" action="/">', data)
+        self.assertEqual(self.client.get('/movie/edit/2').status_code, 404)
+        self.assertEqual(self.client.get('/movie/edit/99999999999999999999').status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/2').status_code, 404)
+        response = self.client.patch('/api/movies', json=[{'id': 2, 'title': 'Stolen'}])
+        self.assertEqual(response.get_json()['results'][0]['status'], 'not_found')
+        self.assertEqual(Movie.query.get(2).title, 'Bob Movie')
+        titles = [m['title'] for m in self.client.get('/api/movies?user=bob').get_json()['movies']]
+        self.assertEqual(titles, ['Bob Movie'])
+        self.assertEqual(self.client.get('/api/movies/2').status_code, 404)
+        self.assertEqual(self.client.get('/api/movies/2?user=bob').get_json()['title'], 'Bob Movie')
+
+        self.client.get('/logout')
+        response = self.client.post('/login', data=dict(username='bob', password='456'), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('Bob Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.client.post('/', data=dict(title='Another', year='2002'))
+        self.assertEqual(Movie.query.filter_by(title='Another').first().user_id, bob.id)
+
+    def test_api_list_movies(self):
+        """测试 API 游标分页查询"""
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000 + i, user=self.user) for i in range(5)])
+        db.session.commit()
+        response = self.client.get('/api/movies?per_page=4&year_to=2010')
+        data = response.get_json()
+        self.assertEqual([m['year'] for m in data['movies']], [2000, 2001, 2002, 2003])
+        self.assertTrue(data['has_next'])
+        data = self.client.get('/api/movies?per_page=4&year_to=2010&after=%d' % data['next_cursor']).get_json()
+        self.assertEqual([m['title'] for m in data['movies']], ['Movie 4'])
+        self.assertFalse(data['has_next'])
+        self.assertEqual(self.client.get('/api/movies/1').get_json()['title'], 'Test Movie Title')
+        response = self.client.get('/api/movies/100')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error'], 'Not Found')
+        self.assertEqual(self.client.get('/api/movies/99999999999999999999').status_code, 404)
+
+    def test_api_batch(self):
+        """测试 API 批量创建、修改和删除，每批只提交一次"""
+        response = self.client.post('/api/movies', json={'movies': [{'title': 'A', 'year': 2000}]})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json()['error'], 'Unauthorized')
+
+        self.login()
+        items = [{'title': 'Movie %d' % i, 'year': 2000 + i} for i in range(50)] + [{'title': '', 'year': 2000}]
+        commits = []
+        on_commit = commits.append
+        event.listen(db.session, 'after_commit', on_commit)
+        try:
+            response = self.client.post('/api/movies', json={'movies': items})
+        finally:
+            event.remove(db.session, 'after_commit', on_commit)
+        data = response.get_json()
+        self.assertEqual(len(commits), 1)
+        self.assertEqual((data['changed'], data['failed']), (50, 1))
+        self.assertEqual(data['results'][-1]['status'], 'invalid')
+        ids = [result['id'] for result in data['results'][:-1]]
+        self.assertEqual(Movie.query.count(), 51)
+
+        response = self.client.patch('/api/movies', json=[{'id': ids[0], 'year': '1999'}, {'id': 9999, 'title': 'X'},
+                                                          {'id': 2 ** 64, 'title': 'X'}])
+        data = response.get_json()
+        self.assertEqual([r['status'] for r in data['results']], ['updated', 'not_found', 'not_found'])
+        movie = Movie.query.get(ids[0])
+        self.assertEqual((movie.title, movie.year), ('Movie 0', 1999))
+
+        # atomic=1 时有一项失败就全部回滚
+        response = self.client.delete('/api/movies?atomic=1', json={'ids': ids[:10] + [9999]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Movie.query.count(), 51)
+
+        response = self.client.delete('/api/movies', json={'ids': ids[:10] + [ids[0]]})
+        data = response.get_json()
+        self.assertEqual((data['changed'], data['results'][-1]['status']), (10, 'not_found'))
+        self.assertEqual(Movie.query.count(), 41)
+        self.assertEqual(self.client.post('/api/movies', data='x').status_code, 415)
+
+    def test_duplicate_movies(self):
+        """测试标题只有大小写和空白不同的同年电影不能重复添加"""
+        self.login()
+        response = self.client.post('/', data=dict(title='  test movie   TITLE ', year='2019'), follow_redirects=True)
+        self.assertIn('Movie already in your list.', response.get_data(as_text=True))
+        self.assertEqual(Movie.query.count(), 1)
+        self.client.post('/', data=dict(title='Test Movie Title', year='2020'))
+        self.assertEqual(Movie.query.count(), 2)
+
+        response = self.client.post('/movie/edit/2', data=dict(title='TEST movie title', year='2019'),
+                                    follow_redirects=True)
+        self.assertIn('Movie already in your list.', response.get_data(as_text=True))
+        self.assertEqual(Movie.query.get(2).year, 2020)
+
+        response = self.client.post('/api/movies', json=[{'title': 'New', 'year': 2000}, {'title': 'NEW', 'year': 2000}])
+        data = response.get_json()
+        self.assertEqual([r['status'] for r in data['results']], ['created', 'duplicate'])
+        self.assertEqual(data['results'][0]['id'], data['results'][1]['id'])
+        self.assertEqual((data['changed'], data['failed']), (1, 1))
+        response = self.client.patch('/api/movies', json=[{'id': 2, 'year': 2019}])
+        self.assertEqual(response.get_json()['results'][0]['status'], 'duplicate')
+
+        # 同一批中重复出现的 id 在前一项修改后的值上继续修改
+        response = self.client.patch('/api/movies', json=[{'id': 2, 'title': 'Renamed'}, {'id': 2, 'year': 1999}])
+        self.assertEqual([r['status'] for r in response.get_json()['results']], ['updated', 'updated'])
+        db.session.expire_all()
+        self.assertEqual((Movie.query.get(2).title, Movie.query.get(2).year), ('Renamed', 1999))
+
+        # 其他用户的清单中可以有同样的电影
+        other = User(name='Other', username='other')
+        db.session.add(other)
+        db.session.commit()
+        self.assertEqual(create_movie(other.id, 'Test Movie Title', 2019)[1], 'created')
+
+    def write_queue_app(self, **config):
+        """辅助方法，创建使用临时数据库文件并开启写队列的程序，写线程使用自己的连接"""
+        db.session.remove()  # 会话按线程共享，先移除绑定到测试程序的会话
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app(dict(TESTING=True, WRITE_QUEUE_ENABLED=True, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+                              SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(directory, 'test.db'), **config))
+        with app.app_context():
+            db.create_all()
+            user = User(name='Test', username='test')
+            user.set_password('123')
+            db.session.add_all([user, Movie(title='Test Movie Title', year=2019, user=user)])
+            db.session.commit()
+
+        def close():
+            if 'write_queue' in app.extensions:
+                app.extensions['write_queue'].close()
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+        self.addCleanup(close)
+        return app
+
+    def test_write_queue_group_commit(self):
+        """测试写队列把多个写操作合并成一个事务，失败的操作只回滚自己"""
+        app = self.write_queue_app(WRITE_QUEUE_BATCH_MS=200, WRITE_QUEUE_BATCH_SIZE=100)
+
+        def insert_then_fail(user_id):
+            create_movie(user_id, 'Rolled Back', 2000)
+            raise ValueError('boom')
+
+        with app.app_context():
+            commits = []
+            on_commit = commits.append
+            event.listen(db.engine, 'commit', on_commit)
+            wq = write_queue()
+            futures = [wq.submit(create_movie, 1, 'Movie %d' % i, 2000) for i in range(50)]
+            failed = wq.submit(insert_then_fail, 1)
+            updated = wq.submit(update_movie, 1, 1, 'Renamed', 2020)
+            self.assertTrue(wq.wait(updated.seq, timeout=10))
+            event.remove(db.engine, 'commit', on_commit)
+
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(len({future.result() for future in futures}), 50)
+            self.assertIsInstance(failed.exception(), ValueError)
+            self.assertEqual(updated.result(), 'updated')
+            self.assertEqual(Movie.query.count(), 51)
+            self.assertEqual(Movie.query.filter_by(title='Rolled Back').count(), 0)
+            self.assertEqual(Movie.query.get(1).title, 'Renamed')
+            self.assertEqual(current_version()[0], 1)
+
+    def test_write_queue_views(self):
+        """测试写队列的两种确认方式，queued 模式下同一会话仍能读到自己的修改"""
+        app = self.write_queue_app(WRITE_QUEUE_ACK='commit')
+        client = app.test_client()
+        client.post('/login', data=dict(username='test', password='123'))
+        response = client.post('/movie/edit/1', data=dict(title='Edited', year='2020'), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie Item Updated.', data)
+        self.assertIn('Edited', data)
+        self.assertEqual(client.post('/movie/delete/99').status_code, 404)
+
+        app = self.write_queue_app(WRITE_QUEUE_ACK='queued', WRITE_QUEUE_BATCH_MS=200)
+        client = app.test_client()
+        client.post('/login', data=dict(username='test', password='123'))
+        response = client.post('/', data=dict(title='Queued Movie', year='2021'), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie Item Created.', data)
+        self.assertIn('Queued Movie', data)
+        response = client.post('/movie/delete/1', follow_redirects=True)
+        self.assertNotIn('Test Movie Title', response.get_data(as_text=True))
+
+    def test_change_log(self):
+        """测试变更日志和按游标获取变更的 JSON 接口"""
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2020'))
+        self.client.post('/movie/edit/2', data=dict(title='New Movie 2', year='2021'))
+        self.client.post('/movie/delete/2')
+
+        data = self.client.get('/api/changes').get_json()
+        self.assertEqual([(c['op'], c['movie']['id']) for c in data['changes']],
+                         [('create', 1), ('create', 2), ('update', 2), ('delete', 2)])
+        self.assertEqual(data['changes'][2]['movie'], {'id': 2, 'title': 'New Movie 2', 'year': 2021})
+        self.assertFalse(data['has_more'])
+        data = self.client.get('/api/changes?since=%d' % data['cursor']).get_json()
+        self.assertEqual(data['changes'], [])
+
+        data = self.client.get('/api/changes?since=1&limit=2').get_json()
+        self.assertEqual([c['op'] for c in data['changes']], ['create', 'update'])
+        self.assertTrue(data['has_more'])
+        self.assertEqual(self.client.get('/api/changes?user=nobody').status_code, 404)
+        # 超出 SQLite 整数范围的游标当作没有游标
+        data = self.client.get('/api/changes?since=99999999999999999999').get_json()
+        self.assertEqual(len(data['changes']), 4)
+
+    def test_change_stream(self):
+        """测试 SSE 事件流从 Last-Event-ID 之后继续推送"""
+        self.app.config.update(CHANGES_STREAM_TIMEOUT=0.2, CHANGES_POLL_INTERVAL=0.05)
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2020'))
+
+        response = self.client.get('/changes', headers={'Last-Event-ID': '1'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        data = response.get_data(as_text=True)
+        self.assertTrue(data.startswith('retry: '))
+        self.assertIn('id: 2\nevent: change\ndata: ', data)
+        self.assertNotIn('id: 1\n', data)
+        event_data = json.loads(data.split('data: ', 1)[1].split('\n', 1)[0])
+        self.assertEqual(event_data['movie'], {'id': 2, 'title': 'New Movie', 'year': 2020})
+
+        # 没有游标时只推送连接之后的变更
+        self.assertNotIn('event: change', self.client.get('/changes').get_data(as_text=True))
+        response = self.client.get('/changes', headers={'Last-Event-ID': '99999999999999999999'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('event: change', response.get_data(as_text=True))
+
+    def test_year_stats(self):
+        """测试触发器增量维护的年份统计、/stats 页面、JSON 接口和 rebuild-stats 命令"""
+        self.login()
+        self.client.post('/', data=dict(title='Leon', year='1994'))
+        self.client.post('/', data=dict(title='Akira', year='1988'))
+        self.client.post('/', data=dict(title='Mahjong', year='1996'))
+        self.client.post('/movie/edit/3', data=dict(title='Akira', year='2019'))  # 1988 -> 2019
+        self.client.post('/movie/delete/4')
+        self.client.post('/api/movies', json=[{'title': 'WALL-E', 'year': 2008}])
+
+        data = self.client.get('/api/stats').get_json()
+        self.assertEqual(data['total'], 4)
+        self.assertEqual(data['years'], [{'year': 1994, 'count': 1}, {'year': 2008, 'count': 1},
+                                         {'year': 2019, 'count': 2}])
+        self.assertEqual(data['decades'], [{'decade': 1990, 'count': 1}, {'decade': 2000, 'count': 1},
+                                           {'decade': 2010, 'count': 2}])
+        data = self.client.get('/stats').get_data(as_text=True)
+        self.assertIn('4 Titles', data)
+        self.assertIn('2010s', data)
+        self.assertNotIn('1980s', data)
+
+        db.session.execute(text('DELETE FROM movie_year_stat'))
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/stats').get_json()['total'], 0)
+        result = self.runner.invoke(args=['rebuild-stats'])
+        self.assertIn('Rebuilt 3 year rows', result.output)
+        self.assertEqual(self.client.get('/api/stats').get_json()['total'], 4)
+        self.assertEqual(self.client.get('/api/stats?user=nobody').status_code, 404)
+
     def test_login_protect(self):
         """测试登录保护"""
         response = self.client.get('/')
         data = response.get_data(as_text=True)
         self.assertNotIn('Logout', data)
         self.assertNotIn('Settings', data)
-        self.assertNotIn('<form method="post">', data)
+        self.assertNotIn('<form method="post" action="/">', data)
         self.assertNotIn('Delete', data)
         self.assertNotIn('Edit', data)
 
@@ -131,7 +734,7 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Settings', data)
         self.assertIn('Delete', data)
         self.assertIn('Edit', data)
-        self.assertIn('<form method="post">', data)
+        self.assertIn('<form method="post" action="/">', data)
 
         # 测试使用错误的密码登录
         response = self.client.post('/login', data=dict(username='test', password='456'), follow_redirects=True)
@@ -157,6 +760,51 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Login success.', data)
         self.assertIn('Invalid input.', data)
 
+    def test_login_rehash(self):
+        """测试登录时用新的哈希参数更新旧的密码哈希"""
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+        self.assertIn('Login success.', response.get_data(as_text=True))
+        user = User.query.first()
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(user.validate_password('123'))
+
+        # 配置中省略迭代次数（werkzeug 的默认写法）时不会每次登录都重新计算；盐的长度改变时也要更新
+        pwhash = generate_password_hash('123', method='pbkdf2:sha256', salt_length=16)
+        self.assertEqual(check_and_rehash(pwhash, '123', 'pbkdf2:sha256', 16), (True, None))
+        valid, new_hash = check_and_rehash(user.password_hash, '123', 'pbkdf2:sha256:2000', 8)
+        self.assertTrue(valid)
+        self.assertEqual(len(new_hash.split('$')[1]), 8)
+
+    def test_login_throttle(self):
+        """测试登录失败次数过多时在校验密码之前返回 429"""
+        self.app.config.update(LOGIN_THROTTLE_BURST=2, LOGIN_THROTTLE_RATE=0.01)
+        for _ in range(2):
+            response = self.client.post('/login', data=dict(username='test', password='456'))
+            self.assertEqual(response.status_code, 302)
+        response = self.client.post('/login', data=dict(username='test', password='123'))
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Too Many Requests', response.get_data(as_text=True))
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+
+        # 其他客户端不受影响，登录成功不消耗令牌
+        for _ in range(3):
+            response = self.client.post('/login', data=dict(username='test', password='123'),
+                                        environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(response.status_code, 302)
+
+    def test_login_hash_pool_busy(self):
+        """测试密码校验线程池排满时返回 503"""
+        self.app.config.update(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_QUEUE=0)
+        release = threading.Event()
+        hash_pool().submit(release.wait)
+        try:
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        finally:
+            release.set()
+
     def test_logout(self):
         """测试登出"""
         self.login()
@@ -168,7 +816,7 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Settings', data)
         self.assertNotIn('Delete', data)
         self.assertNotIn('Edit', data)
-        self.assertNotIn('<form method="post">', data)
+        self.assertNotIn('<form method="post" action="/">', data)
 
     def test_settings(self):
         """测试设置"""
@@ -192,17 +840,356 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Settings updated.', data)
         self.assertIn('Invalid input.', data)
 
+    def test_metrics(self):
+        """测试 /metrics 输出的请求、SQL、模板和响应大小指标"""
+        response = self.client.get('/')
+        response.get_data()
+        response.close()  # 流式响应在关闭时记录指标
+        self.client.get('/nothing')
+        self.client.get('/api/movies')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        data = response.get_data(as_text=True)
+        self.assertIn('watchlist_request_duration_seconds_count{endpoint="main.index",method="GET",status="200"} 1',
+                      data)
+        self.assertIn('endpoint="<unmatched>",method="GET",status="404"', data)
+        self.assertIn('watchlist_request_sql_queries_count{endpoint="main.index"} 1', data)
+        self.assertNotIn('watchlist_request_sql_queries_sum{endpoint="main.index"} 0.0', data)
+        self.assertIn('watchlist_template_render_seconds_count{template="index.html"} 1', data)
+        self.assertIn('watchlist_response_size_bytes_bucket{endpoint="api.list_movies",le="+Inf"} 1', data)
+
+    def test_slow_request_log(self):
+        """测试慢请求日志中列出请求执行的 SQL 语句"""
+        self.app.config['METRICS_SLOW_REQUEST'] = 0.000001
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/').close()
+        self.assertIn('Slow request GET /', logs.output[0])
+        self.assertIn('FROM movie', logs.output[0])
+
+    def test_response_compression(self):
+        """测试按 Accept-Encoding 压缩响应及压缩后的条件请求"""
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000 + i, user=self.user) for i in range(20)])
+        db.session.commit()
+        plain = self.client.get('/')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.vary)
+
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()), plain.get_data())
+        self.assertEqual(response.get_etag()[0], plain.get_etag()[0] + '-gzip')
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # 小响应和已经压缩过的响应不再压缩
+        response = self.client.get('/api/movies/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response = self.client.get('/export.csv?gzip=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(gzip.decompress(response.get_data()).splitlines()[0], b'id,title,year')
+
+    def test_streamed_response_compression(self):
+        """测试流式响应逐块压缩"""
+        chunks = compress_chunks(iter([b'a' * 1000, b'b' * 1000]), 'gzip', 6)
+        first = next(chunks)
+        # 同步刷新后，第一块的压缩结果可以单独解压
+        self.assertEqual(zlib.decompressobj(31).decompress(first), b'a' * 1000)
+        self.assertEqual(gzip.decompress(first + b''.join(chunks)), b'a' * 1000 + b'b' * 1000)
+
+        response = self.client.get('/export.jsonl', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertIn(b'Test Movie Title', gzip.decompress(response.get_data()))
+
+    def test_build_assets(self):
+        """测试静态文件构建、带哈希的 URL 和预压缩文件"""
+        static_folder = os.path.join(tempfile.mkdtemp(), 'static')
+        self.addCleanup(shutil.rmtree, os.path.dirname(static_folder))
+        shutil.copytree(self.app.static_folder, static_folder)
+        self.app.static_folder = static_folder
+        result = self.runner.invoke(args=['build-assets'])
+        self.assertIn('Built 4 assets', result.output)
+        init_assets(self.app)
+
+        data = self.client.get('/').get_data(as_text=True)
+        match = re.search(r'/static/(dist/style\.[0-9a-f]{12}\.css)', data)
+        self.assertIsNotNone(match)
+        self.assertRegex(data, r'/static/dist/images/totoro\.[0-9a-f]{12}\.gif')
+
+        response = self.client.get('/static/' + match.group(1), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        with open(os.path.join(static_folder, 'style.css'), 'rb') as f:
+            self.assertEqual(gzip.decompress(response.get_data()), f.read())
+        response.close()
+
+        response = self.client.get('/static/' + match.group(1))
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+        response = self.client.get('/static/style.css')
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+        response.close()
+
+    def test_sqlite_engine_profile(self):
+        """测试 SQLite 文件数据库的 pragma 和连接池配置"""
+        db.session.remove()
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(directory, 'test.db'),
+                              SQLITE_SYNCHRONOUS='OFF', SQLITE_POOL_SIZE=3)
+            try:
+                db.create_all()
+                self.assertEqual(db.session.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+                self.assertEqual(db.session.execute(text('PRAGMA synchronous')).scalar(), 0)
+                self.assertEqual(db.session.execute(text('PRAGMA busy_timeout')).scalar(), 5000)
+                self.assertIsInstance(db.engine.pool, QueuePool)
+                self.assertEqual(db.engine.pool.size(), 3)
+                db.session.remove()
+                db.engine.dispose()
+            finally:
+                self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+
+        self.app.config['SQLITE_PROFILE'] = 'fast'
+        with self.assertRaises(ValueError):
+            sqlite_pragmas(self.app.config)
+        self.app.config.update(SQLITE_PROFILE='wal', SQLITE_CACHE_SIZE='1; DROP TABLE movie')
+        with self.assertRaises(ValueError):
+            sqlite_pragmas(self.app.config)
+        self.app.config['SQLITE_CACHE_SIZE'] = None
+
+    def test_db_backup_and_maintain_commands(self):
+        """测试在线备份，以及维护命令回收大量删除后留下的空闲页"""
+        db.session.remove()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'test.db')
+        try:
+            db.create_all()
+            db.session.commit()
+            # 新数据库上 ANALYZE 为 sqlite_stat* 表分配的页不能算成负的回收页数
+            self.assertIn('reclaimed 0 pages (0.0 MiB)', self.runner.invoke(args=['db-maintain']).output)
+            user = User(name='Test', username='test')
+            db.session.add_all([Movie(title='Movie %d' % i, year=2000, user=user) for i in range(2000)])
+            db.session.commit()
+
+            path = os.path.join(directory, 'backup.sqlite3')
+            result = self.runner.invoke(args=['db-backup', path, '--pages', '5', '--sleep', '0'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Backed up', result.output)
+            with sqlite3.connect(path) as backup:
+                self.assertEqual(backup.execute('SELECT count(*) FROM movie').fetchone()[0], 2000)
+            self.assertFalse(os.path.exists(path + '.tmp'))
+
+            Movie.query.delete()
+            db.session.commit()
+            result = self.runner.invoke(args=['db-maintain'])
+            self.assertIn('skipped, auto_vacuum is off', result.output)
+            self.assertIn('integrity_check', result.output)
+            result = self.runner.invoke(args=['db-maintain', '--full', '--quick'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('switched to auto_vacuum=INCREMENTAL', result.output)
+            self.assertNotIn('reclaimed 0 pages', result.output)
+
+            db.session.add_all([Movie(title='Movie %d' % i, year=2000, user=user) for i in range(2000)])
+            db.session.commit()
+            Movie.query.delete()
+            db.session.commit()
+            result = self.runner.invoke(args=['db-maintain'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('incremental', result.output)
+            self.assertNotIn('reclaimed 0 pages', result.output)
+            self.assertIsNotNone(db.session.execute(text("SELECT * FROM sqlite_stat1")).first())
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+
+    def test_entry_points(self):
+        """测试只加载 web 或命令行部分的程序"""
+        web_app = create_app('testing', components=('web',))
+        self.assertIn('main.index', web_app.view_functions)
+        self.assertNotIn('forge', web_app.cli.commands)
+        cli_app = create_app('testing', components=('cli',))
+        self.assertNotIn('main.index', cli_app.view_functions)
+        self.assertIn('forge', cli_app.cli.commands)
+        self.assertEqual(create_app({'MOVIES_PER_PAGE': 5}).config['MOVIES_PER_PAGE'], 5)
+
+    def test_startup_report_command(self):
+        """测试冷启动时间报告"""
+        result = self.runner.invoke(args=['startup-report', '--entry', 'cli', '--runs', '1', '--budget', '60000'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('cli entry: median', result.output)
+        self.assertIn('Within budget.', result.output)
+        result = self.runner.invoke(args=['startup-report', '--runs', '1', '--budget', '1'])
+        self.assertIn('over the 1ms budget', result.output)
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_template_bytecode_cache(self):
+        """测试启动时预热模板，编译结果写入字节码缓存，新的进程直接从缓存加载"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config = dict(TESTING=True, TEMPLATE_BYTECODE_CACHE=True, TEMPLATE_CACHE_DIR=directory, TEMPLATE_WARMUP=True)
+        app = create_app(config, components=('web',))
+        loaded = {name for _, name in app.jinja_env.cache}
+        self.assertTrue({'base.html', 'index.html', 'errors/404.html'} <= loaded)
+        self.assertTrue(any(name.endswith('.cache') for name in os.listdir(directory)))
+
+        self.app.config.update(TEMPLATE_BYTECODE_CACHE=True, TEMPLATE_CACHE_DIR=directory)
+        result = self.runner.invoke(args=['template-report'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('index.html', result.output)
+        self.assertNotIn('(written)', result.output)  # 预热时已经全部写入缓存
+        self.assertIn('loaded them from %s' % directory, result.output)
+        result = self.runner.invoke(args=['template-report', '--top', '1'])
+        self.assertEqual(len(result.output.splitlines()), 3)
+
     def test_forge_command(self):
         """测试虚拟数据"""
         result = self.runner.invoke(forge)
         self.assertIn("Done.", result.output)
         self.assertNotEqual(Movie.query.count(), 0)
 
+    def test_forge_command_count(self):
+        """测试按数量和随机种子生成假数据"""
+        result = self.runner.invoke(forge, ['--count', '250', '--seed', '7', '--batch-size', '100'])
+        self.assertIn('Generated 250 movies', result.output)
+        self.assertEqual(Movie.query.count(), 251)
+        first = [(m.title, m.year) for m in Movie.query.order_by(Movie.id).offset(1)]
+
+        Movie.query.delete()
+        db.session.commit()
+        self.runner.invoke(forge, ['--count', '250', '--seed', '7'])
+        second = [(m.title, m.year) for m in Movie.query.order_by(Movie.id)]
+        self.assertEqual(first, second)
+        self.assertEqual(User.query.count(), 1)
+
     def test_initdb_command(self):
         """测试初始化数据库"""
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
 
+    def test_initdb_upgrades_schema(self):
+        """测试 initdb 升级最初版本的数据库：补充 user_id 列，旧电影归第一个用户所有，年份转换成整数"""
+        db.session.execute(text('DROP TABLE movie'))
+        db.session.execute(text('DROP TABLE movie_year_stat'))
+        db.session.execute(text('DROP TABLE movie_fts'))
+        db.session.execute(text('CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4))'))
+        db.session.execute(text("INSERT INTO movie (title, year) VALUES ('Old Movie', '1990')"))
+        db.session.commit()
+        result = self.runner.invoke(initdb)
+        self.assertIn('Initialized database.', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Old Movie').first().user_id, self.user.id)
+        indexes = {row[1] for row in db.session.execute(text("PRAGMA index_list('movie')"))}
+        self.assertIn('ix_movie_user_year_id', indexes)
+        self.assertIn('uq_movie_user_title_key_year', indexes)
+        self.assertEqual(Movie.query.filter_by(title='Old Movie').first().title_key, 'old movie')
+        # 新建的统计表根据旧数据计算
+        self.assertEqual(self.client.get('/api/stats').get_json()['years'], [{'year': 1990, 'count': 1}])
+        self.assertIn('Old Movie', self.client.get('/').get_data(as_text=True))
+        self.assertIn('Old Movie', self.client.get('/search?q=old').get_data(as_text=True))
+        # 年份按整数比较和排序，重建表之后触发器仍然有效
+        self.login()
+        self.client.post('/', data=dict(title='Ancient Movie', year='999'))
+        self.assertEqual(db.session.execute(text('SELECT DISTINCT typeof(year) FROM movie')).scalars().all(),
+                         ['integer'])
+        data = self.client.get('/api/movies?year_from=1000').get_json()
+        self.assertEqual([m['year'] for m in data['movies']], [1990])
+        self.assertIn('Ancient Movie', self.client.get('/search?q=ancient').get_data(as_text=True))
+        self.assertEqual(self.client.get('/api/changes').get_json()['changes'][-1]['movie']['title'], 'Ancient Movie')
+
+    def write_temp_file(self, suffix, content):
+        """辅助方法，写入临时文件并返回路径"""
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_command(self):
+        """测试批量导入命令"""
+        path = self.write_temp_file('.csv', 'title,year\nLeon,1994\n,1995\nWALL-E,2008\n')
+        result = self.runner.invoke(args=['import', path, '--batch-size', '1'])
+        self.assertIn('Imported 2 movies, skipped 1 invalid rows', result.output)
+
+        path = self.write_temp_file('.jsonl', '{"title": "Mahjong", "year": 1996}\n\n{"title": "x"}\n'
+                                              '{"title": "y", "year": "\u00b2"}\n')
+        result = self.runner.invoke(args=['import', path])
+        self.assertIn('Imported 1 movies, skipped 2 invalid rows', result.output)
+
+        path = self.write_temp_file('.txt', '[{"title": "King of Comedy", "year": "1999"}, {"year": "1999"}]')
+        result = self.runner.invoke(args=['import', path, '--format', 'json'])
+        self.assertIn('Imported 1 movies, skipped 1 invalid rows', result.output)
+        self.assertEqual(Movie.query.count(), 5)
+        self.assertEqual(Movie.query.filter_by(title='Mahjong').first().year, 1996)
+
+        path = self.write_temp_file('.json', '[{"title": "Leon", "year": "1994"}')
+        result = self.runner.invoke(args=['import', path])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('Unexpected end of JSON input.', result.output)
+
+    def test_iter_json_small_chunks(self):
+        """测试 JSON 数组的流式解析跨越读取块边界"""
+        movies = [{'title': 'Movie %d' % i, 'year': '2000'} for i in range(50)]
+        fileobj = io.StringIO(json.dumps(movies, indent=2))
+        self.assertEqual(list(iter_json(fileobj, chunk_size=7)), movies)
+        self.assertEqual(list(iter_json(io.StringIO(' [ ] '))), [])
+        with self.assertRaises(ValueError):
+            list(iter_json(io.StringIO('{"title": "Leon"}')))
+
+    def test_export(self):
+        """测试流式导出接口"""
+        db.session.add(Movie(title='Leon, the "Professional"', year='1994', user=self.user))
+        db.session.commit()
+
+        response = self.client.get('/export.csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertTrue(response.is_streamed)
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows, [['id', 'title', 'year'], ['1', 'Test Movie Title', '2019'],
+                                ['2', 'Leon, the "Professional"', '1994']])
+
+        response = self.client.get('/export.jsonl?gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertIn('movies.jsonl.gz', response.headers['Content-Disposition'])
+        lines = gzip.decompress(response.get_data()).decode('utf-8').splitlines()
+        self.assertEqual(json.loads(lines[1]), {'id': 2, 'title': 'Leon, the "Professional"', 'year': 1994})
+
+    def test_export_command(self):
+        """测试导出命令，导出的文件可以重新导入"""
+        path = self.write_temp_file('.jsonl.gz', '')
+        result = self.runner.invoke(args=['export', path, '--gzip'])
+        self.assertEqual(result.exit_code, 0)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.assertEqual(json.loads(f.readline())['title'], 'Test Movie Title')
+
+        result = self.runner.invoke(args=['export', '--format', 'csv'])
+        self.assertEqual(result.output.splitlines(), ['id,title,year', '1,Test Movie Title,2019'])
+        path = self.write_temp_file('.csv', result.output)
+        result = self.runner.invoke(args=['import', path])
+        self.assertIn('skipped 0 invalid rows and 1 duplicates', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Test Movie Title').count(), 1)
+
+    def test_dedupe_command(self):
+        """测试合并建立唯一索引之前已有的重复电影，每组保留最早添加的一部"""
+        db.session.execute(text('DROP INDEX uq_movie_user_title_key_year'))
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': 'test  movie title', 'year': 2019, 'user_id': self.user.id},
+            {'title': 'Another', 'year': 2000, 'user_id': self.user.id},
+            {'title': 'ANOTHER', 'year': 2000, 'user_id': self.user.id},
+            {'title': 'Another', 'year': 2001, 'user_id': self.user.id},
+        ])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['dedupe', '--batch-size', '2'])
+        self.assertIn('Removed 2 duplicate movies', result.output)
+        self.assertEqual([(m.id, m.title_key) for m in Movie.query.order_by(Movie.id)],
+                         [(1, 'test movie title'), (3, 'another'), (5, 'another')])
+        self.assertEqual(year_stats(self.user.id)[0], 3)
+        self.assertEqual(create_movie(self.user.id, 'another', 2000), (3, 'duplicate'))
+        self.assertIn('already exists', self.runner.invoke(args=['dedupe']).output)
+
     def test_admin_command(self):
         """测试生成管理员账户"""
         db.drop_all()
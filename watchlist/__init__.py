@@ -1,38 +1,100 @@
-"""包构造文件，创建程序实例"""
+"""包构造文件，提供程序工厂 create_app()"""
 import os
+import threading
 
-from flask import Flask
+from flask import Flask, current_app
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
 
+from watchlist.engine import SQLAlchemy
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////' + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE','db.sqlite3'))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
+# 程序的组成部分：web 包含视图和错误处理，cli 包含命令，只注册需要的部分可以减少导入的模块
+COMPONENTS = ('web', 'cli')
 
+_extension_lock = threading.RLock()
 
-@login_manager.user_loader # 将函数指定为回调函数
-def load_user(user_id):
-    from watchlist.models import User
-    user = User.query.get(int(user_id))
-    return user
 
+def create_app(config=None, components=COMPONENTS):
+    """程序工厂。
+
+    config 可以是配置名称（development、testing、production，默认读取 FLASK_CONFIG 环境变量）、
+    配置类或字典（在 BaseConfig 的基础上更新）。
+    """
+    from watchlist.settings import BaseConfig, config as configs
+
+    app = Flask('watchlist')
+    if config is None:
+        config = os.getenv('FLASK_CONFIG', 'development')
+    if isinstance(config, str):
+        app.config.from_object(configs[config])
+    elif isinstance(config, dict):
+        app.config.from_object(BaseConfig)
+        app.config.update(config)
+    else:
+        app.config.from_object(config)
+
+    db.init_app(app)
+    # 模型、全文索引、变更日志和统计触发器的 DDL 事件不管哪个组成部分都需要
+    from watchlist import changes, models, search, stats  # noqa: F401
+
+    if 'web' in components:
+        register_web(app)
+    if 'cli' in components:
+        register_commands(app)
+    return app
 
-login_manager.login_view = 'login'
 
+def register_web(app):
+    from watchlist.api import api_bp
+    from watchlist.assets import init_assets
+    from watchlist.changes import changes_bp
+    from watchlist.compression import init_compression
+    from watchlist.errors import errors_bp
+    from watchlist.stats import stats_bp
+    from watchlist.templating import init_templates
+    from watchlist.views import main_bp
+    from watchlist.writequeue import init_write_queue
 
-@app.context_processor
-def inject_user():
-    from watchlist.models import User
-    user = User.query.first()
-    return dict(user=user)
+    login_manager.init_app(app)
+    if app.config['METRICS_ENABLED']:
+        from watchlist.metrics import metrics_bp
+        app.register_blueprint(metrics_bp)  # 最先注册，请求计时包含其他蓝本的请求钩子
+    app.register_blueprint(main_bp)
+    app.register_blueprint(errors_bp)
+    app.register_blueprint(api_bp)
+    app.register_blueprint(changes_bp)
+    app.register_blueprint(stats_bp)
+    init_write_queue(app)
+    init_assets(app)
+    init_compression(app)  # 最后注册的 after_request 钩子最先执行
+    init_templates(app)  # 模板中用到的过滤器和全局变量都注册之后再预热
 
 
-# 写在最下面，views,errors,commands中要导入的app和db变量已经在本文件中执行过了，避免了循环导入。
-from watchlist import views, errors, commands
+def register_commands(app):
+    from watchlist.commands import commands_bp
 
+    app.register_blueprint(commands_bp)
 
+
+def app_extension(name, factory):
+    """返回当前程序的 app.extensions[name]，第一次使用时调用 factory(app) 创建。
+
+    多个线程同时第一次访问时只有一个线程调用 factory，其他线程等它创建完成后取得同一个对象。
+    """
+    app = current_app._get_current_object()
+    extension = app.extensions.get(name)
+    if extension is None:
+        with _extension_lock:
+            extension = app.extensions.get(name)
+            if extension is None:
+                extension = app.extensions[name] = factory(app)
+    return extension
+
+
+@login_manager.user_loader  # 将函数指定为回调函数
+def load_user(user_id):
+    from watchlist.cache import get_user
+    return get_user(int(user_id))
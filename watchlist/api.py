@@ -0,0 +1,240 @@
+"""电影 JSON API：游标分页查询，以及在一个事务中批量创建、修改和删除"""
+from flask import Blueprint, jsonify, request, current_app, abort
+from flask_login import current_user
+from sqlalchemy.orm.attributes import set_committed_value
+
+from watchlist import db
+from watchlist.cache import page_cache
+from watchlist.changes import changes_since
+from watchlist.models import Movie, bump_version, create_movie, update_movie, validate_movie
+from watchlist.owners import request_owner
+from watchlist.pagination import MAX_INTEGER, cursor_param
+from watchlist.stats import year_stats
+from watchlist.views import index_filters, movie_page, owner_id
+
+api_bp = Blueprint('api', __name__, url_prefix='/api')
+
+# SQLite 旧版本限制一条语句最多 999 个参数，IN 查询按这个大小分批
+IN_CHUNK_SIZE = 500
+
+
+def movie_to_dict(movie):
+    return {'id': movie.id, 'title': movie.title, 'year': movie.year}
+
+
+def json_error(e):
+    return jsonify(error=e.name, message=e.description), e.code
+
+
+for code in (400, 401, 404, 413, 415, 422):
+    api_bp.register_error_handler(code, json_error)
+
+
+@api_bp.before_request
+def require_login_for_writes():
+    # 写操作需要登录，未登录时返回 JSON 格式的 401，而不是重定向到登录页面
+    if request.method != 'GET' and not current_user.is_authenticated:
+        abort(401)
+
+
+@api_bp.route('/movies', methods=['GET'])
+def list_movies():
+    """?after=/?before= 游标分页，支持和主页相同的 year_from、year_to、sort 参数。
+
+    默认返回当前用户（未登录时为站点默认用户）的电影，?user=<username> 返回指定用户的电影。
+    """
+    owner = request_owner()
+    per_page = request.args.get('per_page', current_app.config['MOVIES_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['API_MAX_PER_PAGE']))
+    page = movie_page(owner, request.args.get('after', type=cursor_param),
+                      request.args.get('before', type=cursor_param),
+                      index_filters(), per_page)
+    return jsonify(movies=[movie_to_dict(movie) for movie in page.items],
+                   has_next=page.has_next, has_prev=page.has_prev,
+                   next_cursor=page.next_cursor if page.has_next else None,
+                   prev_cursor=page.prev_cursor if page.has_prev else None)
+
+
+@api_bp.route('/movies/<int:movie_id>', methods=['GET'])
+def get_movie(movie_id):
+    """和 /api/movies 一样只在当前清单（或 ?user=<username> 的清单）中查找，别人的电影返回 404"""
+    owner = request_owner()
+    if movie_id > MAX_INTEGER:
+        abort(404)
+    return jsonify(movie_to_dict(Movie.query.filter_by(id=movie_id, user_id=owner_id(owner)).first_or_404()))
+
+
+@api_bp.route('/changes', methods=['GET'])
+def list_changes():
+    """?since=<id> 之后的变更（默认从头开始），按 id 排序；客户端保存 cursor，下次从这里继续。
+
+    和 /api/movies 一样默认返回当前清单的变更，?user=<username> 指定用户。
+    """
+    owner = request_owner()
+    since = max(request.args.get('since', 0, type=cursor_param), 0)
+    limit = request.args.get('limit', current_app.config['CHANGES_BATCH_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['CHANGES_BATCH_SIZE']))
+    changes = changes_since(owner.id if owner is not None else None, since, limit + 1)
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return jsonify(changes=[change.to_dict() for change in changes],
+                   cursor=changes[-1].id if changes else since, has_more=has_more)
+
+
+@api_bp.route('/stats', methods=['GET'])
+def get_stats():
+    """按年份和年代统计的电影数量，只读取 movie_year_stat 聚合表"""
+    owner = request_owner()
+    total, years, decades = year_stats(owner.id if owner is not None else None)
+    return jsonify(total=total, years=[{'year': year, 'count': count} for year, count in years],
+                   decades=[{'decade': decade, 'count': count} for decade, count in decades])
+
+
+@api_bp.route('/movies', methods=['POST'])
+def create_movies():
+    """批量创建：{"movies": [{"title": ..., "year": ...}, ...]}
+
+    清单中已有同名同年的电影（包括同一批中前面的项目）时返回 duplicate 和已有电影的 id。
+    """
+    items = batch_items('movies')
+    results = []
+    created = 0
+    for index, item in enumerate(items):
+        fields = clean_fields(item, required=True)
+        if fields is None:
+            results.append({'index': index, 'status': 'invalid', 'error': 'Invalid title or year.'})
+            continue
+        movie_id, status = create_movie(current_user.id, fields['title'], fields['year'])
+        if status == 'created':
+            created += 1
+        results.append({'index': index, 'id': movie_id, 'status': status})
+    return finish_batch(results, created)
+
+
+@api_bp.route('/movies', methods=['PATCH'])
+def update_movies():
+    """批量修改：{"movies": [{"id": ..., "title": ..., "year": ...}, ...]}，title 和 year 可以只给出一个。
+
+    只能修改和删除当前用户自己的电影，别人的电影按不存在处理；改成清单中已有的同名同年电影时返回 duplicate，不修改。
+    """
+    items = batch_items('movies')
+    movies = load_movies([item.get('id') for item in items if isinstance(item, dict) and is_id(item.get('id'))])
+    results = []
+    updated = 0
+    for index, item in enumerate(items):
+        movie_id = item.get('id') if isinstance(item, dict) else None
+        movie = movies.get(movie_id) if is_id(movie_id) else None
+        if movie is None:
+            results.append({'index': index, 'id': movie_id, 'status': 'not_found'})
+            continue
+        fields = clean_fields(item, required=False, current=movie)
+        if fields is None:
+            results.append({'index': index, 'id': movie_id, 'status': 'invalid', 'error': 'Invalid title or year.'})
+            continue
+        title, year = fields.get('title', movie.title), fields.get('year', movie.year)
+        status = update_movie(current_user.id, movie_id, title, year)
+        if status == 'updated':
+            # UPDATE 语句不会更新已经加载的对象，同一批中再次出现这个 id 时要在新的值上修改
+            set_committed_value(movie, 'title', title)
+            set_committed_value(movie, 'year', year)
+            updated += 1
+        results.append({'index': index, 'id': movie_id, 'status': status})
+    return finish_batch(results, updated)
+
+
+@api_bp.route('/movies', methods=['DELETE'])
+def delete_movies():
+    """批量删除：{"ids": [1, 2, 3]}"""
+    ids = batch_items('ids')
+    existing = set(load_movie_ids([movie_id for movie_id in ids if is_id(movie_id)]))
+    results = []
+    deleted = []
+    for index, movie_id in enumerate(ids):
+        if is_id(movie_id) and movie_id in existing:
+            existing.discard(movie_id)  # 重复的 id 只删除一次
+            deleted.append(movie_id)
+            results.append({'index': index, 'id': movie_id, 'status': 'deleted'})
+        else:
+            results.append({'index': index, 'id': movie_id, 'status': 'not_found'})
+    for start in range(0, len(deleted), IN_CHUNK_SIZE):
+        Movie.query.filter(Movie.id.in_(deleted[start:start + IN_CHUNK_SIZE])).delete(synchronize_session=False)
+    return finish_batch(results, len(deleted))
+
+
+def batch_items(key):
+    """读取请求体中的列表，也接受直接以列表作为请求体"""
+    if not request.is_json:
+        abort(415, 'Request body must be JSON.')
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get(key)
+    if not isinstance(data, list):
+        abort(400, 'Expected a JSON list or an object with a "%s" list.' % key)
+    if len(data) > current_app.config['API_MAX_BATCH']:
+        abort(413, 'At most %d items per request.' % current_app.config['API_MAX_BATCH'])
+    return data
+
+
+def clean_fields(item, required, current=None):
+    """校验一条记录，返回需要写入的字段，无效时返回 None；年份可以是整数或数字字符串"""
+    if not isinstance(item, dict):
+        return None
+    if required and ('title' not in item or 'year' not in item):
+        return None
+    title = item.get('title', current.title if current is not None else None)
+    year = item.get('year', current.year if current is not None else None)
+    if isinstance(year, bool) or not isinstance(year, (int, str)) or not isinstance(title, str):
+        return None
+    year = str(year)
+    if not validate_movie(title, year):
+        return None
+    fields = {}
+    if 'title' in item:
+        fields['title'] = title
+    if 'year' in item:
+        fields['year'] = int(year)
+    return fields
+
+
+def is_id(value):
+    # 排除 True/False，以及绑定到 SQLite 时会溢出的整数
+    return type(value) is int and 0 < value <= MAX_INTEGER
+
+
+def load_movies(ids):
+    movies = {}
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[start:start + IN_CHUNK_SIZE]
+        for movie in Movie.query.filter(Movie.user_id == current_user.id, Movie.id.in_(chunk)):
+            movies[movie.id] = movie
+    return movies
+
+
+def load_movie_ids(ids):
+    found = []
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[start:start + IN_CHUNK_SIZE]
+        found.extend(movie_id for movie_id, in
+                     db.session.query(Movie.id).filter(Movie.user_id == current_user.id, Movie.id.in_(chunk)))
+    return found
+
+
+def finish_batch(results, changed):
+    """提交整批修改：只有一次提交和一次缓存失效。
+
+    ?atomic=1 时只要有一项失败就回滚全部修改并返回 422，否则提交有效的项目。
+    """
+    failed = sum(1 for result in results if result['status'] in ('invalid', 'not_found', 'duplicate'))
+    if failed and request.args.get('atomic', type=int) == 1:
+        db.session.rollback()
+        for result in results:
+            if result['status'] == 'created':
+                del result['id']
+            if result['status'] in ('created', 'updated', 'deleted'):
+                result['status'] = 'rolled_back'
+        return jsonify(results=results, changed=0, failed=failed), 422
+    if changed:
+        bump_version()
+        db.session.commit()
+        page_cache().clear()
+    return jsonify(results=results, changed=changed, failed=failed)
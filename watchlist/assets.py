@@ -0,0 +1,128 @@
+"""静态文件构建：按内容哈希重命名并预压缩，url_for('static') 自动指向带哈希的文件名。
+
+flask build-assets 把 static 目录中的文件复制到 static/dist，文件名中加入内容哈希
+（style.css -> dist/style.1a2b3c4d5e6f.css），文本文件另外生成 .gz 和 .br（需要安装 brotli）压缩版本，
+并写入 manifest.json。程序启动时读取清单，带哈希的文件内容不会改变，可以设置一年的 immutable 缓存，
+浏览器重复访问页面时不再请求静态文件。没有构建清单时（例如开发环境）一切照旧。
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖，没有安装时只生成 gzip 版本
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+# 需要预压缩的文本类文件，图片等已经压缩过的格式不再压缩
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.json', '.txt', '.map', '.html')
+# 按优先顺序排列的预压缩编码及其文件扩展名
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def build_assets(static_folder, output='dist', clean=False):
+    """构建带哈希的静态文件，返回清单。clean 为 True 时先删除旧的构建结果"""
+    output_dir = os.path.join(static_folder, output)
+    if clean and os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest = {'assets': {}, 'encodings': {}}
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder) and output in dirs:
+            dirs.remove(output)  # 跳过构建输出目录
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            source = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            base, ext = os.path.splitext(source)
+            target = '%s/%s.%s%s' % (output, base, hashlib.sha1(data).hexdigest()[:12], ext)
+            target_path = os.path.join(static_folder, *target.split('/'))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path, 'wb') as f:
+                f.write(data)
+            manifest['assets'][source] = target
+
+            if ext.lower() in COMPRESSIBLE:
+                encodings = []
+                for encoding, suffix in ENCODINGS:
+                    compressed = compress(data, encoding)
+                    # 压缩后没有明显变小的文件直接发送原文件
+                    if compressed is not None and len(compressed) < len(data) * 0.95:
+                        with open(target_path + suffix, 'wb') as f:
+                            f.write(compressed)
+                        encodings.append(encoding)
+                if encodings:
+                    manifest['encodings'][target] = encodings
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9, mtime=0)  # mtime=0 使构建结果可复现
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=11)
+    return None
+
+
+class Assets(object):
+    """程序启动时读取的构建清单"""
+
+    def __init__(self, manifest):
+        self.assets = manifest.get('assets', {})
+        self.encodings = manifest.get('encodings', {})
+        self.hashed = set(self.assets.values())
+
+
+def init_assets(app):
+    """有构建清单时让 url_for('static') 使用带哈希的文件名，并替换静态文件视图"""
+    path = os.path.join(app.static_folder, app.config['ASSETS_DIR'], MANIFEST_NAME)
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        app.extensions['assets'] = Assets(json.load(f))
+    app.url_defaults(hashed_static_url)
+    app.view_functions['static'] = send_asset
+
+
+def hashed_static_url(endpoint, values):
+    if endpoint == 'static':
+        filename = values.get('filename')
+        hashed = current_app.extensions['assets'].assets.get(filename)
+        if hashed is not None:
+            values['filename'] = hashed
+
+
+def send_asset(filename):
+    """发送带哈希的文件时选择客户端接受的预压缩版本，并设置 immutable 缓存"""
+    assets = current_app.extensions['assets']
+    if filename not in assets.hashed:
+        return current_app.send_static_file(filename)
+
+    encodings = assets.encodings.get(filename, ())
+    response = None
+    for encoding, suffix in ENCODINGS:
+        if encoding in encodings and request.accept_encodings[encoding]:
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(current_app.static_folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = send_from_directory(current_app.static_folder, filename)
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['ASSETS_MAX_AGE']
+    response.cache_control.immutable = True
+    response.cache_control.no_cache = None
+    return response
@@ -0,0 +1,135 @@
+"""登录保护：在有界线程池中校验密码，并用令牌桶限制每个客户端的登录尝试频率"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from watchlist import app_extension
+
+
+class PoolBusy(Exception):
+    """密码校验线程池的等待队列已满"""
+
+
+class HashPool(object):
+    """执行密码哈希的线程池，同时执行和排队的任务总数不超过 workers + queue_size。
+
+    hashlib 在计算 PBKDF2 时会释放 GIL，哈希可以在线程池中并行执行；
+    池的大小限制了同一时刻占用的 CPU，队列满时立即拒绝，而不是让所有 worker 都卡在哈希计算上。
+    """
+
+    def __init__(self, workers, queue_size):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusy()
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def hash_pool():
+    """返回当前程序的密码校验线程池，第一次使用时创建"""
+    return app_extension('hash_pool', lambda app: HashPool(
+        app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE']))
+
+
+def password_hash_options():
+    return dict(method=current_app.config['PASSWORD_HASH_METHOD'],
+                salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+@lru_cache(maxsize=8)
+def hash_prefix(method):
+    """method 生成的哈希的前缀：werkzeug 总是写入迭代次数，例如 pbkdf2:sha256 生成 pbkdf2:sha256:260000"""
+    return generate_password_hash('', method=method, salt_length=1).split('$', 1)[0]
+
+
+def check_and_rehash(pwhash, password, method, salt_length):
+    """校验密码，密码正确且哈希使用的参数已经过时时，一并计算新的哈希。
+
+    返回 (密码是否正确, 新的哈希或 None)，在线程池中执行。
+    """
+    if not pwhash or not check_password_hash(pwhash, password):
+        return False, None
+    prefix, salt = pwhash.split('$', 2)[:2]
+    if prefix != hash_prefix(method) or len(salt) != salt_length:
+        return True, generate_password_hash(password, method=method, salt_length=salt_length)
+    return True, None
+
+
+def verify_password(user, password):
+    """在线程池中校验用户密码，队列已满时抛出 PoolBusy，超时抛出 concurrent.futures.TimeoutError"""
+    options = password_hash_options()
+    future = hash_pool().submit(check_and_rehash, user.password_hash, password,
+                                options['method'], options['salt_length'])
+    return future.result(timeout=current_app.config['PASSWORD_HASH_TIMEOUT'])
+
+
+class Throttle(object):
+    """按客户端（IP 地址）计数的令牌桶：容量为 burst，每秒补充 rate 个令牌。
+
+    只保存在进程内存中，多 worker 部署时每个进程分别限制；
+    客户端数量超过 max_clients 时丢弃已经补满的桶，内存占用有上限。
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> [令牌数, 上次更新时间]
+
+    def _refill(self, bucket, now):
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+    def consume(self, key):
+        """取出一个令牌，成功时返回 0，否则返回需要等待的秒数"""
+        if self.burst <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_clients:
+                    self._prune(now)
+                bucket = self._buckets[key] = [self.burst, now]
+            self._refill(bucket, now)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate if self.rate > 0 else float('inf')
+
+    def refund(self, key):
+        """归还一个令牌，登录成功的尝试不计入限制"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+
+    def _prune(self, now):
+        for key, bucket in list(self._buckets.items()):
+            self._refill(bucket, now)
+            if bucket[0] >= self.burst:
+                del self._buckets[key]
+        if len(self._buckets) >= self.max_clients:
+            self._buckets.clear()
+
+
+def login_throttle():
+    """返回当前程序的登录限流器"""
+    return app_extension('login_throttle', lambda app: Throttle(
+        app.config['LOGIN_THROTTLE_RATE'], app.config['LOGIN_THROTTLE_BURST']))
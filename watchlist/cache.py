@@ -0,0 +1,226 @@
+"""缓存工具：用户缓存和渲染后页面的缓存"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from watchlist import app_extension, db
+
+
+class UserCache(object):
+    """进程级用户缓存，按用户 id 保存（None 表示站点默认用户，即第一个用户）。
+
+    保存的是脱离会话（detached）的用户快照，每个请求通过
+    ``db.session.merge(snapshot, load=False)`` 得到属于自己会话的副本，不会产生查询，
+    也不会在线程之间共享同一个 ORM 实例。最多保存 maxsize 个用户，超出时丢弃最久未使用的。
+    generation 在每次失效时加一，请求级缓存据此判断自己是否已经过期。
+    """
+
+    def __init__(self, maxsize=1024):
+        self._lock = threading.Lock()
+        self._snapshots = OrderedDict()  # key -> (snapshot, expires_at)
+        self.maxsize = maxsize
+        self.generation = 0
+
+    def get(self, key=None):
+        with self._lock:
+            item = self._snapshots.get(key)
+            if item is None or time.monotonic() >= item[1]:
+                return None
+            self._snapshots.move_to_end(key)
+            return item[0]
+
+    def set(self, user, ttl, key=None):
+        from watchlist.models import User
+        state = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+        snapshot = User(**state)
+        make_transient_to_detached(snapshot)
+        with self._lock:
+            self._snapshots[key] = (snapshot, time.monotonic() + ttl)
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.maxsize:
+                self._snapshots.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshots.clear()
+            self.generation += 1
+
+
+def user_cache():
+    """返回当前程序的进程级用户缓存，第一次使用时创建"""
+    return app_extension('user_cache', lambda app: UserCache())
+
+
+def get_user(user_id=None):
+    """返回 id 为 user_id 的用户，user_id 为 None 时返回站点默认用户（第一个用户，未登录的访客看到的是他的清单）。
+
+    同一个请求内每个用户只查询一次；开启 USER_CACHE_TTL 后多数请求不查询数据库。
+    """
+    generation = user_cache().generation
+    cached = g.get('users')
+    if cached is None or cached[0] != generation:
+        cached = g.users = (generation, {})
+    users = cached[1]
+    if user_id not in users:
+        users[user_id] = _load_user(user_id)
+    return users[user_id]
+
+
+def _load_user(user_id):
+    from watchlist.models import User
+    ttl = current_app.config['USER_CACHE_TTL']
+    if ttl > 0:
+        snapshot = user_cache().get(user_id)
+        if snapshot is not None:
+            return db.session.merge(snapshot, load=False)
+    user = User.query.order_by(User.id).first() if user_id is None else User.query.get(user_id)
+    if user is not None and ttl > 0:
+        user_cache().set(user, ttl, user_id)
+    return user
+
+
+def invalidate_user_cache():
+    """用户数据修改后调用，清除本进程内的请求级和进程级缓存"""
+    user_cache().invalidate()
+
+
+class NullCache(object):
+    """不缓存任何内容，PAGE_CACHE_TYPE 的默认值"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(object):
+    """进程内 LRU 缓存。
+
+    每个 worker 进程各有一份，写操作只能清除本进程的缓存，
+    多进程部署时用 timeout 限制其他进程读到旧页面的时间，或者改用 FileSystemCache。
+    """
+
+    def __init__(self, maxsize=128, timeout=0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at and time.monotonic() >= expires_at:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.timeout if self.timeout else 0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileSystemCache(object):
+    """文件系统缓存，同一台机器上的多个 worker 共享，clear() 对所有进程生效。
+
+    缓存的值需要能序列化为 JSON。
+    """
+
+    suffix = '.page'
+
+    def __init__(self, directory, threshold=500, timeout=0):
+        self.directory = directory
+        self.threshold = threshold
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + self.suffix)
+
+    def _files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith(self.suffix)]
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if self.timeout and time.time() - os.path.getmtime(path) >= self.timeout:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        self._prune()
+        # 先写临时文件再原子替换，其他进程不会读到写了一半的页面
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _prune(self):
+        files = self._files()
+        if len(files) < self.threshold:
+            return
+        files.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+        for path in files[:len(files) - self.threshold + 1]:
+            self._remove(path)
+
+    def clear(self):
+        for path in self._files():
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def create_page_cache(app):
+    """按 PAGE_CACHE_TYPE 配置创建页面缓存后端"""
+    cache_type = app.config['PAGE_CACHE_TYPE']
+    timeout = app.config['PAGE_CACHE_TIMEOUT']
+    if cache_type == 'lru':
+        return LRUCache(app.config['PAGE_CACHE_SIZE'], timeout)
+    if cache_type == 'filesystem':
+        directory = app.config['PAGE_CACHE_DIR'] or os.path.join(app.instance_path, 'page-cache')
+        return FileSystemCache(directory, app.config['PAGE_CACHE_SIZE'], timeout)
+    if cache_type == 'null':
+        return NullCache()
+    raise ValueError('Unknown PAGE_CACHE_TYPE: %r' % cache_type)
+
+
+def page_cache():
+    """返回当前程序使用的页面缓存后端，首次调用时按配置创建"""
+    return app_extension('page_cache', create_page_cache)
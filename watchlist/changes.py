@@ -0,0 +1,151 @@
+"""电影变更日志和 Server-Sent Events 变更推送。
+
+movie 表每次增删改都在 movie_change 表追加一行。
+客户端先加载一次清单，之后通过 /changes（SSE 事件流）或 /api/changes?since=<id>（JSON）
+只获取游标之后的变更，不再重复下载整个清单。断线重连时浏览器会在 Last-Event-ID 请求头中带上最后收到的事件 id，
+事件流从那里继续。
+"""
+import json
+import threading
+import time
+
+from flask import Blueprint, Response, current_app, request, stream_with_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from watchlist import db
+from watchlist.models import MovieChange, movie_ddl
+from watchlist.owners import request_owner
+from watchlist.pagination import cursor_param
+
+changes_bp = Blueprint('changes', __name__)
+
+RECONNECT_MS = 3000  # 连接断开后浏览器等待多久重连
+
+SCHEMA = (
+    """CREATE TRIGGER IF NOT EXISTS movie_change_insert AFTER INSERT ON movie BEGIN
+        INSERT INTO movie_change(user_id, movie_id, op, title, year, created_at)
+        VALUES (new.user_id, new.id, 'create', new.title, new.year, CURRENT_TIMESTAMP);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_change_update AFTER UPDATE OF title, year ON movie BEGIN
+        INSERT INTO movie_change(user_id, movie_id, op, title, year, created_at)
+        VALUES (new.user_id, new.id, 'update', new.title, new.year, CURRENT_TIMESTAMP);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_change_delete AFTER DELETE ON movie BEGIN
+        INSERT INTO movie_change(user_id, movie_id, op, created_at)
+        VALUES (old.user_id, old.id, 'delete', CURRENT_TIMESTAMP);
+    END""",
+)
+
+
+# 触发器中的 movie_change 表在执行时才解析，可以比它先创建
+install_triggers = movie_ddl(SCHEMA)
+
+
+class ChangeNotifier(object):
+    """本进程内有事务提交时唤醒等待中的事件流，不必等到下一次轮询；其他进程的修改靠轮询发现"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self._generation != generation, timeout)
+            return self._generation
+
+
+notifier = ChangeNotifier()
+
+
+@event.listens_for(Session, 'after_flush')
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def mark_written(*args):
+    # 只在写过数据的事务提交后通知，事件流自己的只读事务提交时不通知
+    session = args[0] if isinstance(args[0], Session) else args[0].session
+    session.info['watchlist.written'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_commit(session):
+    if session.info.pop('watchlist.written', False):
+        notifier.notify()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_written(session):
+    session.info.pop('watchlist.written', None)
+
+
+def changes_since(user_id, since, limit):
+    """user_id 在 since 之后的变更，按 id 排序，最多 limit 条，使用 (user_id, id) 索引"""
+    return MovieChange.query.filter(MovieChange.user_id == user_id, MovieChange.id > since) \
+        .order_by(MovieChange.id).limit(limit).all()
+
+
+def latest_change_id(user_id):
+    return db.session.query(db.func.max(MovieChange.id)).filter(MovieChange.user_id == user_id).scalar() or 0
+
+
+def event_cursor():
+    """事件流的起点：Last-Event-ID 请求头或 ?since= 参数，都没有或无效时为 None，表示只推送之后的变更"""
+    value = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        return max(cursor_param(value), 0) if value is not None else None
+    except ValueError:  # 不是整数，或者超出 SQLite 整数范围
+        return None
+
+
+@changes_bp.route('/changes')
+def stream_changes():
+    """SSE 事件流，默认推送当前清单（登录后是自己的）的变更，?user=<username> 指定用户。
+
+    每条连接最长保持 CHANGES_STREAM_TIMEOUT 秒，之后由浏览器带着 Last-Event-ID 自动重连，
+    同步 worker 不会被一直占用；空闲时每 CHANGES_HEARTBEAT 秒发送一次注释行，避免代理断开连接。
+    """
+    owner = request_owner()
+    user_id = owner.id if owner is not None else None
+    cursor = event_cursor()
+    if cursor is None:
+        cursor = latest_change_id(user_id)
+    db.session.commit()  # 不要在整个连接期间占用读事务
+
+    config = current_app.config
+    response = Response(stream_with_context(change_events(
+        user_id, cursor, config['CHANGES_POLL_INTERVAL'], config['CHANGES_HEARTBEAT'],
+        config['CHANGES_STREAM_TIMEOUT'], config['CHANGES_BATCH_SIZE'])), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 让 nginx 不缓冲事件流
+    return response
+
+
+def change_events(user_id, cursor, poll_interval, heartbeat, timeout, batch_size):
+    yield 'retry: %d\n\n' % RECONNECT_MS
+    deadline = time.monotonic() + timeout
+    last_sent = time.monotonic()
+    generation = notifier.generation
+    while time.monotonic() < deadline:
+        changes = [change.to_dict() for change in changes_since(user_id, cursor, batch_size)]
+        db.session.commit()  # 每次查询后结束事务，下一次查询能看到新的提交，连接也归还给连接池
+        if changes:
+            cursor = changes[-1]['id']
+            last_sent = time.monotonic()
+            yield ''.join('id: %d\nevent: change\ndata: %s\n\n' % (change['id'], json.dumps(change))
+                          for change in changes)
+            if len(changes) == batch_size:
+                continue  # 还有没有发送的变更
+        elif time.monotonic() - last_sent >= heartbeat:
+            last_sent = time.monotonic()
+            yield ': keep-alive\n\n'
+        now = time.monotonic()
+        generation = notifier.wait(generation, max(0, min(poll_interval, deadline - now, last_sent + heartbeat - now)))
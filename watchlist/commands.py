@@ -1,55 +1,194 @@
+import os
+import random
+import subprocess
+import sys
+import time
+
 import click
+from flask import Blueprint, current_app
+from sqlalchemy import Integer, MetaData, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+
+from watchlist import db
+from watchlist.cache import invalidate_user_cache, page_cache
+from watchlist.changes import install_triggers
+from watchlist.dedupe import backfill_title_keys, has_unique_index, remove_duplicates, unique_index
+from watchlist.models import User, Movie, MovieYearStat, bump_version
+from watchlist.search import install_index, rebuild_index
+from watchlist.stats import install_triggers as install_stat_triggers, rebuild_stats
+
+# cli_group=None 把命令直接注册为 flask 的子命令，例如 flask forge
+commands_bp = Blueprint('commands', __name__, cli_group=None)
+
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+# forge --count 生成标题时使用的单词
+TITLE_WORDS = ('Love', 'War', 'Night', 'City', 'Dream', 'Star', 'Ghost', 'River', 'Summer', 'Winter',
+               'King', 'Girl', 'Boy', 'Road', 'House', 'Song', 'Fire', 'Sea', 'Moon', 'Last',
+               'Secret', 'Lost', 'Golden', 'Silent', 'Wild', 'Little', 'Dark', 'Blue', 'Red', 'Time')
 
 
-@app.cli.command()
-def forge():
+def fake_movies(count, seed=None):
+    """生成 count 条随机电影记录，seed 相同时结果相同，方便复现基准测试；标题带序号，不会被当作重复的电影忽略"""
+    rand = random.Random(seed)
+    for i in range(count):
+        words = rand.sample(TITLE_WORDS, rand.randint(1, 4))
+        yield {'title': '%s %d' % (' '.join(words), i + 1), 'year': rand.randint(1920, 2025)}
+
+
+@commands_bp.cli.command()
+@click.option('--count', type=click.IntRange(min=0),
+              help='Generate COUNT random movies with bulk inserts instead of the demo list.')
+@click.option('--seed', type=int, default=0, show_default=True, help='Random seed used with --count.')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows per bulk INSERT with --count.')
+@click.option('--user', 'username', help='Owner of the movies generated with --count, defaults to the first user.')
+def forge(count, seed, batch_size, username):
     """生成假数据"""
     db.create_all()
 
+    if count is not None:
+        from watchlist.importer import import_records
+
+        if username is None and User.query.first() is None:
+            db.session.add(User(name='cxw'))
+            db.session.commit()
+        user = find_user(username)
+        stats = import_records(fake_movies(count, seed), batch_size=batch_size, user_id=user.id)
+        invalidate_user_cache()
+        click.echo('Generated %d movies in %.2fs (%.0f rows/s).' % (stats.imported, stats.elapsed, stats.rate))
+        return
+
     name = 'cxw'
     movies = [
-        {'title': 'My Neighbor Totoro', 'year': '1988'},
-        {'title': 'Dead Poets Society', 'year': '1989'},
-        {'title': 'A Perfect World', 'year': '1993'},
-        {'title': 'Leon', 'year': '1994'},
-        {'title': 'Mahjong', 'year': '1996'},
-        {'title': 'Swallowtail Butterfly', 'year': '1996'},
-        {'title': 'King of Comedy', 'year': '1999'},
-        {'title': 'Devils on the Doorstep', 'year': '1999'},
-        {'title': 'WALL-E', 'year': '2008'},
-        {'title': 'The Pork of Music', 'year': '2012'},
+        {'title': 'My Neighbor Totoro', 'year': 1988},
+        {'title': 'Dead Poets Society', 'year': 1989},
+        {'title': 'A Perfect World', 'year': 1993},
+        {'title': 'Leon', 'year': 1994},
+        {'title': 'Mahjong', 'year': 1996},
+        {'title': 'Swallowtail Butterfly', 'year': 1996},
+        {'title': 'King of Comedy', 'year': 1999},
+        {'title': 'Devils on the Doorstep', 'year': 1999},
+        {'title': 'WALL-E', 'year': 2008},
+        {'title': 'The Pork of Music', 'year': 2012},
     ]
 
     user = User(name=name)
     db.session.add(user)
     for m in movies:
-        movie = Movie(title=m['title'], year=m['year'])
+        movie = Movie(title=m['title'], year=m['year'], user=user)
         db.session.add(movie)
 
+    bump_version()
     db.session.commit()
+    invalidate_user_cache()
+    page_cache().clear()
     click.echo('Done.')
 
 
-@app.cli.command()
+@commands_bp.cli.command()
 @click.option('--drop', is_flag=True, help="Create after drop.")
 def initdb(drop):
     """Initialized database."""
     if drop:
         db.drop_all()
     db.create_all()
+    upgrade_schema()
+    bump_version()
+    db.session.commit()
+    invalidate_user_cache()
+    page_cache().clear()
     click.echo('Initialized database.')
 
 
-@app.cli.command()
+def upgrade_schema():
+    """create_all 不会修改已经存在的表，这里为旧数据库补充新增的列和索引"""
+    columns = {column['name']: column for column in inspect(db.engine).get_columns('movie')}
+    if 'user_id' not in columns:
+        db.session.execute(text('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES "user" (id)'))
+        # 多用户之前的电影都属于第一个用户
+        db.session.execute(text('UPDATE movie SET user_id = (SELECT min(id) FROM "user") WHERE user_id IS NULL'))
+    if 'title_key' not in columns:
+        db.session.execute(text('ALTER TABLE movie ADD COLUMN title_key VARCHAR(60)'))
+    if not isinstance(columns['year']['type'], Integer):
+        rebuild_movie_table()
+    # 以 user_id 开头的索引取代了旧的单列排序索引
+    for name in ('ix_movie_year_id', 'ix_movie_title_id'):
+        db.session.execute(text('DROP INDEX IF EXISTS %s' % name))
+    db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS uq_user_username ON "user" (username)'))
+    install_triggers()  # 之后的修改才记入变更日志
+    install_stat_triggers()
+    db.session.commit()
+    if db.engine.dialect.name == 'sqlite' and not inspect(db.engine).has_table('movie_fts'):
+        rebuild_index()  # 全文搜索之前的数据库，创建索引和触发器并索引已有的电影
+    else:
+        install_index()  # 重建 movie 表时删除了触发器
+    backfill_title_keys()
+    if Movie.query.first() is not None and MovieYearStat.query.first() is None:
+        rebuild_stats()  # 统计表是新建的
+    for index in Movie.__table__.indexes:
+        try:
+            index.create(db.engine, checkfirst=True)
+        except IntegrityError:
+            # 旧数据中有重复的电影，合并之前不能建立唯一索引，写入时也就还不会忽略重复的电影
+            click.echo('Duplicate movies found, run "flask dedupe" to merge them and create %s.' % index.name,
+                       err=True)
+
+
+def rebuild_movie_table():
+    """最初的 movie 表中 year 是 VARCHAR(4)，SQLite 不能修改列的类型，按现在的表结构重建表并把年份转换成整数，
+    否则年份按文本比较和排序，年份范围筛选和按年份排序都不正确。
+
+    删除旧表时它的索引和触发器也一起删除，由 upgrade_schema() 之后的步骤重新创建；电影的 id 保持不变。
+    """
+    metadata = MetaData()
+    User.__table__.to_metadata(metadata)  # 外键引用的表
+    new_table = Movie.__table__.to_metadata(metadata, name='movie_new')
+    db.session.execute(text('DROP TABLE IF EXISTS movie_new'))
+    db.session.execute(CreateTable(new_table))  # 只建表，不建索引，索引名称还被旧表占用
+    names = ', '.join(column.name for column in new_table.columns if column.name != 'year')
+    db.session.execute(text('INSERT INTO movie_new (%s, year) SELECT %s, CAST(year AS INTEGER) FROM movie'
+                            % (names, names)))
+    db.session.execute(text('DROP TABLE movie'))
+    db.session.execute(text('ALTER TABLE movie_new RENAME TO movie'))
+    db.session.commit()
+
+
+def find_user(username=None):
+    """按用户名查找用户，username 为 None 时返回第一个用户"""
+    if username is None:
+        user = User.query.order_by(User.id).first()
+        if user is None:
+            raise click.ClickException('There are no users yet, run "flask admin" or "flask user-add" first.')
+        return user
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException('No user named %s.' % username)
+    return user
+
+
+@commands_bp.cli.command()
+def reindex():
+    """Rebuild the full-text search index."""
+    started_at = time.monotonic()
+    rebuild_index()
+    click.echo('Indexed %d movies in %.2fs.' % (Movie.query.count(), time.monotonic() - started_at))
+
+
+@commands_bp.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the per-year statistics from the movie table."""
+    started_at = time.monotonic()
+    rows = rebuild_stats()
+    click.echo('Rebuilt %d year rows in %.2fs.' % (rows, time.monotonic() - started_at))
+
+
+@commands_bp.cli.command()
 @click.option('--username', prompt=True, help='The username used to login.')
 @click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
 def admin(username, password):
     """create user."""
     db.create_all()
-    user = User.query.first()
+    user = User.query.order_by(User.id).first()  # 只更新第一个用户，其他用户用 user-add 添加
     if user is not None:
         click.echo('Updating user ...')
         user.username = username
@@ -59,6 +198,238 @@ def admin(username, password):
         user = User(username=username, name='Admin')
         user.set_password(password)
         db.session.add(user)
+    bump_version()
     db.session.commit()
+    invalidate_user_cache()
+    page_cache().clear()
     click.echo('Done.')
 
+
+@commands_bp.cli.command('user-add')
+@click.option('--username', prompt=True, help='The username used to login.')
+@click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
+@click.option('--name', help='Name shown on the watchlist, defaults to the username.')
+def user_add(username, password, name):
+    """Add another user with an empty watchlist."""
+    db.create_all()
+    if User.query.filter_by(username=username).first() is not None:
+        raise click.ClickException('User %s already exists.' % username)
+    user = User(username=username, name=name or username)
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
+    click.echo('Created user %s, the watchlist is at /user/%s.' % (username, username))
+
+
+@commands_bp.cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl', 'json']),
+              help='Input format, guessed from the file extension by default.')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows per bulk INSERT and commit.')
+@click.option('--user', 'username', help='Owner of the imported movies, defaults to the first user.')
+def import_movies(file, fmt, batch_size, username):
+    """Import movies from a CSV, JSON Lines or JSON file ("-" for stdin)."""
+    from watchlist.importer import guess_format, import_records, readers
+
+    fmt = fmt or guess_format(file.name)
+    if fmt is None:
+        raise click.UsageError('Cannot guess the format of %s, use --format.' % file.name)
+    db.create_all()
+    user = find_user(username)
+
+    last_report = [0.0]
+
+    def progress(stats):
+        # 每秒最多输出一次进度
+        if time.monotonic() - last_report[0] >= 1:
+            last_report[0] = time.monotonic()
+            click.echo('%d imported, %d skipped, %d duplicates, %.0f rows/s'
+                       % (stats.imported, stats.skipped, stats.duplicates, stats.rate))
+
+    try:
+        stats = import_records(readers[fmt](file), batch_size=batch_size, progress=progress, user_id=user.id)
+    except ValueError as e:
+        raise click.ClickException('Invalid %s input: %s' % (fmt, e))
+    click.echo('Imported %d movies, skipped %d invalid rows and %d duplicates in %.2fs (%.0f rows/s).'
+               % (stats.imported, stats.skipped, stats.duplicates, stats.elapsed, stats.rate))
+
+
+@commands_bp.cli.command('export')
+@click.argument('file', type=click.File('wb'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Output format, guessed from the file extension by default (csv).')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched from the cursor at a time.')
+@click.option('--user', 'username', help='Only export this user\'s movies, all users by default.')
+def export_movies(file, fmt, compress, batch_size, username):
+    """Export movies as CSV or JSON Lines to FILE (stdout by default)."""
+    from watchlist.exporter import export_chunks
+    from watchlist.importer import guess_format
+
+    name = getattr(file, 'name', None)  # 标准输出等文件对象可能没有名称
+    name = name[:-3] if isinstance(name, str) and name.endswith('.gz') else str(name)
+    fmt = fmt or guess_format(name) or 'csv'
+    if fmt not in ('csv', 'jsonl'):
+        raise click.UsageError('Cannot export as %s, use --format.' % fmt)
+    user_id = find_user(username).id if username is not None else None
+    for chunk in export_chunks(fmt, compress=compress, batch_size=batch_size, user_id=user_id):
+        file.write(chunk)
+
+
+@commands_bp.cli.command('build-assets')
+@click.option('--clean', is_flag=True, help='Remove previously built assets first.')
+def build_assets_command(clean):
+    """Fingerprint and precompress static files for far-future caching."""
+    from watchlist.assets import brotli, build_assets
+
+    manifest = build_assets(current_app.static_folder, current_app.config['ASSETS_DIR'], clean=clean)
+    for source, target in sorted(manifest['assets'].items()):
+        encodings = manifest['encodings'].get(target)
+        click.echo('%s -> %s%s' % (source, target, ' (%s)' % ', '.join(encodings) if encodings else ''))
+    if brotli is None:
+        click.echo('brotli is not installed, only gzip versions were written.')
+    page_cache().clear()  # 缓存的页面中还是旧的文件名
+    click.echo('Built %d assets, restart the app to use them.' % len(manifest['assets']))
+
+
+@commands_bp.cli.command('db-backup')
+@click.argument('target', required=False, type=click.Path(dir_okay=False))
+@click.option('--pages', default=256, show_default=True, help='Pages copied per step, -1 copies all at once.')
+@click.option('--sleep', default=0.05, show_default=True, help='Seconds to pause between steps.')
+def db_backup(target, pages, sleep):
+    """Copy the database to TARGET with the online backup API while the site keeps running."""
+    from watchlist.maintenance import backup_database
+
+    if target is None:
+        os.makedirs(os.path.join(current_app.instance_path, 'backups'), exist_ok=True)
+        target = os.path.join(current_app.instance_path, 'backups',
+                              'watchlist-%s.sqlite3' % time.strftime('%Y%m%d-%H%M%S'))
+    last_report = [0.0]
+
+    def progress(status, remaining, total):
+        if time.monotonic() - last_report[0] >= 1 and total:
+            last_report[0] = time.monotonic()
+            click.echo('%d/%d pages copied' % (total - remaining, total))
+
+    try:
+        total, elapsed = backup_database(target, pages=pages, sleep=sleep, progress=progress)
+    except (RuntimeError, OSError) as e:
+        raise click.ClickException(str(e))
+    click.echo('Backed up %d pages (%.1f MiB) to %s in %.2fs.'
+               % (total, os.path.getsize(target) / 1048576.0, target, elapsed))
+
+
+@commands_bp.cli.command()
+@click.option('--batch-size', default=5000, show_default=True, help='Rows scanned per batch and commit.')
+def dedupe(batch_size):
+    """Merge duplicate movies (same normalized title and year) and create the unique index."""
+    started_at = time.monotonic()
+    removed = 0
+    if has_unique_index():
+        click.echo('The unique index already exists, there are no duplicates.')
+    else:
+        backfill_title_keys(batch_size)
+        removed = remove_duplicates(batch_size)
+        try:
+            unique_index().create(db.engine)
+        except IntegrityError:
+            # 合并期间又写入了重复的电影
+            raise click.ClickException('New duplicates were added while merging, run "flask dedupe" again.')
+    click.echo('Removed %d duplicate movies in %.2fs.' % (removed, time.monotonic() - started_at))
+
+
+@commands_bp.cli.command('db-maintain')
+@click.option('--full', is_flag=True,
+              help='Run a full VACUUM (blocks writes) if incremental vacuum is not enabled yet, and enable it.')
+@click.option('--vacuum-pages', default=0, show_default=True, help='Free pages to reclaim, 0 reclaims all of them.')
+@click.option('--analysis-limit', default=1000, show_default=True,
+              help='Rows ANALYZE reads per index, 0 reads everything.')
+@click.option('--quick', is_flag=True, help='Run PRAGMA quick_check instead of the full integrity_check.')
+def db_maintain(full, vacuum_pages, analysis_limit, quick):
+    """Reclaim free pages, refresh planner statistics and check integrity."""
+    from watchlist.maintenance import maintain_database
+
+    try:
+        report = maintain_database(vacuum_pages=vacuum_pages, full_vacuum=full, analysis_limit=analysis_limit,
+                                   quick_check=quick)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    for name, elapsed, detail in report.steps:
+        click.echo('%-16s %8.1fms  %s' % (name, elapsed * 1000, detail))
+    click.echo('Pages: %d -> %d (%d free -> %d free), reclaimed %d pages (%.1f MiB).'
+               % (report.pages_before, report.pages_after, report.free_before, report.free_after,
+                  report.pages_reclaimed, report.pages_reclaimed * report.page_size / 1048576.0))
+    if report.integrity_errors:
+        for error in report.integrity_errors[:20]:
+            click.echo(error, err=True)
+        raise click.ClickException('Integrity check failed.')
+
+
+@commands_bp.cli.command('template-report')
+@click.option('--top', default=0, show_default=True, help='Only list the TOP slowest templates, 0 lists all.')
+def template_report(top):
+    """Report how long each template takes to compile and to load from the bytecode cache."""
+    from watchlist.templating import bytecode_cache, template_timings
+
+    cache = bytecode_cache(current_app)
+    timings = template_timings(current_app.jinja_env, cache)
+    if not timings:
+        raise click.ClickException('No templates found.')
+    total_compile = sum(compile_seconds for _, compile_seconds, _, _ in timings)
+    click.echo('%-24s %10s %10s' % ('template', 'compile', 'cached'))
+    for name, compile_seconds, load_seconds, cached in sorted(timings, key=lambda item: -item[1])[:top or None]:
+        click.echo('%-24s %8.1fms %10s%s' % (name, compile_seconds * 1000,
+                                              '-' if load_seconds is None else '%.1fms' % (load_seconds * 1000),
+                                              '' if cached or cache is None else '  (written)'))
+    if cache is None:
+        click.echo('Compiled %d templates in %.1fms, the bytecode cache is disabled (TEMPLATE_BYTECODE_CACHE).'
+                   % (len(timings), total_compile * 1000))
+    else:
+        total_load = sum(load_seconds for _, _, load_seconds, _ in timings)
+        click.echo('Compiled %d templates in %.1fms, loaded them from %s in %.1fms.'
+                   % (len(timings), total_compile * 1000, cache.directory, total_load * 1000))
+
+
+# 在新的解释器中测量冷启动：导入入口模块并创建程序，输出耗时（毫秒）
+STARTUP_SCRIPT = """import time
+started_at = time.perf_counter()
+import wsgi
+wsgi.create_%s_app()
+print((time.perf_counter() - started_at) * 1000)
+"""
+
+
+@commands_bp.cli.command('startup-report')
+@click.option('--entry', type=click.Choice(['web', 'cli']), default='web', show_default=True,
+              help='The wsgi.py entry point to measure.')
+@click.option('--runs', default=5, show_default=True, help='Number of cold starts to measure.')
+@click.option('--budget', type=int, help='Budget in milliseconds, defaults to STARTUP_TIME_BUDGET.')
+@click.option('--top', default=10, show_default=True, help='Number of slowest imports to list.')
+def startup_report(entry, runs, budget, top):
+    """Measure cold start time of an entry point against the budget."""
+    budget = budget or current_app.config['STARTUP_TIME_BUDGET']
+    root = os.path.dirname(current_app.root_path)
+    script = STARTUP_SCRIPT % entry
+    timings, imports = [], {}
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=root,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise click.ClickException(result.stderr.strip().splitlines()[-1])
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+        # -X importtime 输出格式：import time: self [us] | cumulative | imported package
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                name = parts[2].strip()
+                imports[name] = max(imports.get(name, 0), int(parts[1]))
+    timings.sort()
+    median = timings[len(timings) // 2]
+    click.echo('%s entry: median %.0fms, min %.0fms, max %.0fms over %d runs (budget %dms)'
+               % (entry, median, timings[0], timings[-1], runs, budget))
+    click.echo('Slowest imports (cumulative):')
+    for name, cumulative in sorted(imports.items(), key=lambda item: -item[1])[:top]:
+        click.echo('  %8.1fms  %s' % (cumulative / 1000, name))
+    if median > budget:
+        raise click.ClickException('Startup time %.0fms is over the %dms budget.' % (median, budget))
+    click.echo('Within budget.')
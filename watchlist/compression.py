@@ -0,0 +1,107 @@
+"""响应压缩：根据 Accept-Encoding 用 gzip 或 brotli（需要安装 brotli）压缩文本类响应。
+
+普通响应整体压缩；流式响应（例如导出）逐块压缩，每块之后同步刷新，
+已经生成的内容可以立即发送给客户端，内存中不需要保存整个响应。
+"""
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖
+    brotli = None
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding():
+    """返回客户端接受的、质量值最高的编码，相同时优先使用 br，都不接受时返回 None"""
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compressor(encoding, level):
+    if encoding == 'br':
+        return brotli.Compressor(quality=min(level, 11))
+    return zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 生成 gzip 格式
+
+
+def compress_body(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    c = compressor(encoding, level)
+    return c.compress(data) + c.flush()
+
+
+def compress_chunks(chunks, encoding, level, charset='utf-8'):
+    """逐块压缩流式响应，关闭时一并关闭原来的可迭代对象（例如 stream_with_context 的生成器）"""
+    c = compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            if encoding == 'br':
+                data = c.process(chunk) + c.flush()
+            else:
+                data = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield c.finish() if encoding == 'br' else c.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def compress_response(response):
+    """after_request 钩子，需要最后注册，这样会最先执行，其他钩子看到的都是压缩后的响应"""
+    config = current_app.config
+    if not config['COMPRESS_ENABLED'] or response.mimetype not in config['COMPRESS_MIMETYPES']:
+        return response
+    if response.status_code < 200 or response.status_code == 204 \
+            or 'Content-Encoding' in response.headers or 'Content-Range' in response.headers \
+            or response.direct_passthrough or response.cache_control.no_transform:
+        return response
+    if not response.is_streamed and response.status_code != 304 \
+            and (response.content_length or 0) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # 压缩后的内容与原内容不同，强 ETag 需要区分，views.not_modified 会去掉这个后缀再比较
+        response.set_etag('%s-%s' % (etag, encoding))
+    if response.status_code == 304:
+        return response
+
+    level = config['COMPRESS_LEVEL']
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding, level, response.charset)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress_body(response.get_data(), encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def strip_encoding(etag):
+    """去掉 compress_response 加在 ETag 后面的编码后缀"""
+    for encoding in ('br', 'gzip'):
+        suffix = '-' + encoding
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,78 @@
+"""合并清单中重复的电影：标题规范化后相同、年份也相同的电影只保留最早添加的一部，供 flask dedupe 和 initdb 使用。
+
+唯一索引 uq_movie_user_title_key_year 建立之后，新的重复记录在写入时就被忽略；这里处理的是建立索引之前已经存在的重复记录。
+"""
+from sqlalchemy import bindparam, inspect, text
+
+from watchlist import db
+from watchlist.cache import page_cache
+from watchlist.models import Movie, bump_version, normalize_title
+
+UNIQUE_INDEX = 'uq_movie_user_title_key_year'
+SCAN_INDEX = 'tmp_movie_dedupe'
+
+# 一批 id 范围内的电影，如果同一个清单中有 id 更小的同名同年电影就删除；EXISTS 子查询使用临时索引
+DELETE_SQL = """DELETE FROM movie WHERE id IN (
+    SELECT m.id FROM movie AS m WHERE m.id > :after AND m.id <= :upto AND EXISTS (
+        SELECT 1 FROM movie AS d
+        WHERE d.user_id IS m.user_id AND d.title_key = m.title_key AND d.year = m.year AND d.id < m.id))"""
+
+
+def unique_index():
+    return next(index for index in Movie.__table__.indexes if index.name == UNIQUE_INDEX)
+
+
+def has_unique_index():
+    return any(index['name'] == UNIQUE_INDEX for index in inspect(db.engine).get_indexes('movie'))
+
+
+def backfill_title_keys(batch_size=5000):
+    """为旧记录计算 title_key，按 id 分批更新，每批提交一次，返回更新的行数"""
+    update = Movie.__table__.update().where(Movie.id == bindparam('movie_id')) \
+        .values(title_key=bindparam('key'))
+    updated = 0
+    after = 0
+    while True:
+        rows = db.session.query(Movie.id, Movie.title) \
+            .filter(Movie.id > after, Movie.title_key.is_(None)).order_by(Movie.id).limit(batch_size).all()
+        if not rows:
+            return updated
+        db.session.execute(update, [{'movie_id': movie_id, 'key': normalize_title(title)} for movie_id, title in rows])
+        db.session.commit()
+        updated += len(rows)
+        after = rows[-1][0]
+
+
+def remove_duplicates(batch_size=5000, progress=None):
+    """删除重复的电影，返回删除的行数。
+
+    按 id 顺序每次扫描 batch_size 行，每批一次提交，网站在合并期间可以继续读写。
+    删除经过 movie 表上的触发器，搜索索引、变更日志和年份统计同时更新。progress 是可选的回调函数，
+    每批提交后以 (扫描到的 id, 已删除的行数) 为参数调用。
+    """
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS %s ON movie (user_id, title_key, year, id)' % SCAN_INDEX))
+    db.session.commit()
+    removed = 0
+    after = 0
+    try:
+        while True:
+            upto = db.session.execute(text('SELECT max(id) FROM (SELECT id FROM movie WHERE id > :after '
+                                           'ORDER BY id LIMIT :limit)'),
+                                      {'after': after, 'limit': batch_size}).scalar()
+            if upto is None:
+                break
+            deleted = db.session.execute(text(DELETE_SQL), {'after': after, 'upto': upto}).rowcount
+            if deleted:
+                removed += deleted
+                bump_version()
+            db.session.commit()
+            if deleted:
+                page_cache().clear()
+            after = upto
+            if progress is not None:
+                progress(after, removed)
+    finally:
+        db.session.rollback()
+        db.session.execute(text('DROP INDEX IF EXISTS %s' % SCAN_INDEX))
+        db.session.commit()
+    return removed
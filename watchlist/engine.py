@@ -0,0 +1,74 @@
+"""SQLite 引擎配置：WAL 等 pragma 和连接池大小"""
+import re
+
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
+
+# 预设的 pragma 组合，可以用 SQLITE_JOURNAL_MODE 等配置单独覆盖其中的某一项
+SQLITE_PROFILES = {
+    # SQLite 自身的默认设置（回滚日志模式），只设置忙等待时间
+    'default': {
+        'busy_timeout': 5000,
+    },
+    # 多 worker 部署：WAL 模式下读写互不阻塞，synchronous=NORMAL 在 WAL 下不会损坏数据库，
+    # 只是断电时可能丢失最后几个事务；写操作遇到锁时最多等待 busy_timeout 毫秒
+    'wal': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,  # 负数表示 KiB，即每个连接 16 MiB 页缓存
+        'mmap_size': 128 * 1024 * 1024,
+    },
+}
+
+# busy_timeout 需要最先设置，切换 journal_mode 时可能要等待其他连接释放锁
+PRAGMA_ORDER = ('busy_timeout', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size')
+
+
+def sqlite_pragmas(config):
+    """根据 SQLITE_PROFILE 及单项配置返回需要在每个连接上执行的 pragma"""
+    profile = config['SQLITE_PROFILE']
+    if profile not in SQLITE_PROFILES:
+        raise ValueError('Unknown SQLITE_PROFILE: %r' % profile)
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for name in PRAGMA_ORDER:
+        value = config.get('SQLITE_' + name.upper())
+        if value is not None:
+            if not re.match(r'^-?\w+$', str(value)):
+                raise ValueError('Invalid value for SQLITE_%s: %r' % (name.upper(), value))
+            pragmas[name] = value
+    return [(name, pragmas[name]) for name in PRAGMA_ORDER if name in pragmas]
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            cursor.close()
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """为 SQLite 文件数据库配置连接池，并在每个新连接上执行 pragma"""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername == 'sqlite' and options.get('poolclass') in (None, NullPool) \
+                and sa_url.database not in (None, '', ':memory:'):
+            # 默认的 NullPool 每次请求都要重新打开数据库文件并执行 pragma；
+            # 每个 worker 进程各有一个连接池，大小应与 worker 的线程数相当
+            options['poolclass'] = QueuePool
+            options.setdefault('pool_size', app.config['SQLITE_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['SQLITE_MAX_OVERFLOW'])
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            set_sqlite_pragmas(engine, sqlite_pragmas(self.get_app().config))
+        return engine
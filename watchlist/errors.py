@@ -1,20 +1,81 @@
-from flask import render_template
+import time
 
-from watchlist import app
+from flask import Blueprint, current_app, request
+from sqlalchemy.exc import SQLAlchemyError
 
+from watchlist import db
+from watchlist.cache import get_user, user_cache
 
-@app.errorhandler(404)
+errors_bp = Blueprint('errors', __name__)
+
+
+class ErrorPages(object):
+    """渲染好的错误页面，按 (模板, 程序根路径) 保存，用户缓存失效或过期后整体丢弃"""
+
+    def __init__(self, generation, expires_at):
+        self.generation = generation
+        self.expires_at = expires_at
+        self.pages = {}
+
+
+def error_page(template_name):
+    """返回渲染好的错误页面。
+
+    错误页面不经过 render_template，不运行 inject_user 等上下文处理器，也不读取当前登录的用户，
+    页面中显示站点默认用户的名字和未登录时的导航。渲染结果缓存在进程内，用户缓存失效
+    （例如在 settings 中修改了名字）或超过 ERROR_PAGE_CACHE_TTL 秒后重新渲染，
+    扫描随机 URL 产生的大量 404 不会访问数据库。
+    """
+    generation = user_cache().generation
+    now = time.monotonic()
+    pages = current_app.extensions.get('error_pages')
+    if pages is None or pages.generation != generation or now >= pages.expires_at:
+        pages = current_app.extensions['error_pages'] = ErrorPages(
+            generation, now + current_app.config['ERROR_PAGE_CACHE_TTL'])
+    key = (template_name, request.script_root)
+    page = pages.pages.get(key)
+    if page is None:
+        try:
+            page = render_error_page(template_name, get_user())
+        except SQLAlchemyError:
+            # 数据库出错时（例如 500 页面）不显示名字，也不缓存这个页面
+            db.session.rollback()
+            return render_error_page(template_name, None)
+        pages.pages[key] = page
+    return page
+
+
+def render_error_page(template_name, user):
+    return current_app.jinja_env.get_template(template_name).render(
+        user=user, current_user=current_app.login_manager.anonymous_user(),
+        get_flashed_messages=lambda *args, **kwargs: [])  # 提示消息留给下一个正常页面显示
+
+
+@errors_bp.app_errorhandler(404)
 def page_not_found(e):
-    return render_template('errors/404.html'), 404
+    return error_page('errors/404.html'), 404
 
 
-@app.errorhandler(500)
+@errors_bp.app_errorhandler(500)
 def internal_server_error(e):
-    return render_template('errors/500.html'), 500
+    return error_page('errors/500.html'), 500
 
 
-@app.errorhandler(400)
+@errors_bp.app_errorhandler(400)
 def bad_request(e):
-    return render_template('errors/400.html'), 400
+    return error_page('errors/400.html'), 400
+
+
+@errors_bp.app_errorhandler(429)
+def too_many_requests(e):
+    return error_page('errors/429.html'), 429, retry_after_headers(e)
+
+
+@errors_bp.app_errorhandler(503)
+def service_unavailable(e):
+    return error_page('errors/503.html'), 503, retry_after_headers(e)
 
 
+def retry_after_headers(e):
+    retry_after = getattr(e, 'retry_after', None)
+    return {'Retry-After': str(retry_after)} if retry_after is not None else {}
@@ -0,0 +1,69 @@
+"""把电影记录流式导出为 CSV 或 JSON Lines"""
+import csv
+import io
+import json
+import zlib
+
+from watchlist import db
+from watchlist.models import Movie
+
+FIELDS = ('id', 'title', 'year')
+
+mimetypes = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+def iter_rows(batch_size=1000, user_id=None):
+    """用服务端游标逐批读取记录，任何时候内存中最多只有 batch_size 行；user_id 为 None 时导出所有用户的电影"""
+    query = db.session.query(Movie.id, Movie.title, Movie.year).order_by(Movie.id)
+    if user_id is not None:
+        query = query.filter(Movie.user_id == user_id)
+    return query.yield_per(batch_size)
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n'
+
+
+writers = {'csv': csv_lines, 'jsonl': jsonl_lines}
+
+
+def encode_chunks(lines, chunk_size=64 * 1024):
+    """把逐行生成的文本合并成不小于 chunk_size 的字节块，减少写入和发送次数"""
+    parts, size = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        parts.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(parts)
+            parts, size = [], 0
+    if parts:
+        yield b''.join(parts)
+
+
+def gzip_chunks(chunks, level=6):
+    """逐块进行 gzip 压缩，不需要缓存全部数据"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 生成 gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(fmt, compress=False, batch_size=1000, user_id=None):
+    """生成导出文件内容的字节块"""
+    chunks = encode_chunks(writers[fmt](iter_rows(batch_size, user_id)))
+    return gzip_chunks(chunks) if compress else chunks
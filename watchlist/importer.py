@@ -0,0 +1,145 @@
+"""从 CSV、JSON Lines 和 JSON 文件流式批量导入电影"""
+import csv
+import json
+import os
+import re
+import time
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from watchlist import db
+from watchlist.cache import page_cache
+from watchlist.models import Movie, bump_version, normalize_title, validate_movie
+
+FORMATS = ('csv', 'jsonl', 'json')
+
+# JSON 数组中单个元素的最大长度，超过时认为输入有误，避免把整个文件读进内存
+MAX_JSON_ITEM_SIZE = 1024 * 1024
+
+_json_separators = re.compile(r'[\s,]*')
+
+
+def guess_format(filename):
+    """根据扩展名猜测文件格式，无法判断时返回 None"""
+    ext = os.path.splitext(filename)[1].lower().lstrip('.')
+    if ext == 'ndjson':
+        return 'jsonl'
+    return ext if ext in FORMATS else None
+
+
+def iter_csv(fileobj):
+    """CSV 文件需要有 title 和 year 两列表头"""
+    return csv.DictReader(fileobj)
+
+
+def iter_jsonl(fileobj):
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_json(fileobj, chunk_size=64 * 1024):
+    """逐个解析顶层 JSON 数组中的元素，内存占用只和读取块及单个元素的大小有关"""
+    decoder = json.JSONDecoder()
+    buffer, pos = '', 0
+    opened = False
+    while True:
+        pos = _json_separators.match(buffer, pos).end()
+        if pos < len(buffer):
+            if not opened:
+                if buffer[pos] != '[':
+                    raise ValueError('JSON input must be an array of movies.')
+                opened = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # 元素被读取块截断了，继续读取；过长时说明输入有误
+                if len(buffer) - pos > MAX_JSON_ITEM_SIZE:
+                    raise ValueError('Invalid JSON near offset %d.' % pos)
+            else:
+                yield item
+                continue
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            raise ValueError('Unexpected end of JSON input.')
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+readers = {'csv': iter_csv, 'jsonl': iter_jsonl, 'json': iter_json}
+
+
+def clean_record(record):
+    """把一条记录整理成 Movie 表的一行，无效时返回 None"""
+    if not isinstance(record, dict):
+        return None
+    title = record.get('title')
+    year = record.get('year')
+    title = title.strip() if isinstance(title, str) else ''
+    year = str(year).strip() if isinstance(year, (str, int)) and not isinstance(year, bool) else ''
+    if not validate_movie(title, year):
+        return None
+    return {'title': title, 'title_key': normalize_title(title), 'year': int(year)}
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.duplicates = 0  # 清单中已有的同名同年电影
+        self.started_at = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self):
+        return self.imported / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def import_records(records, batch_size=5000, progress=None, user_id=None):
+    """按批插入记录，每批一条 executemany 语句和一次提交，内存中最多只有一批数据。
+
+    导入的电影都属于 user_id，清单中已有（或同一个文件中重复出现）的电影由唯一索引忽略，计入 duplicates；progress 是可选的回调函数，每提交一批后以 ImportStats 为参数调用。
+    """
+    stats = ImportStats()
+    insert = sqlite_insert(Movie.__table__).on_conflict_do_nothing()
+    batch = []
+    try:
+        for record in records:
+            row = clean_record(record)
+            if row is None:
+                stats.skipped += 1
+                continue
+            row['user_id'] = user_id
+            batch.append(row)
+            if len(batch) >= batch_size:
+                _insert_batch(insert, batch, stats, progress)
+                batch = []
+        if batch:
+            _insert_batch(insert, batch, stats, progress)
+    except Exception:
+        db.session.rollback()  # 已经提交的批次保留，出错的批次回滚
+        raise
+    finally:
+        if stats.imported:
+            bump_version()
+            db.session.commit()
+            page_cache().clear()
+    return stats
+
+
+def _insert_batch(insert, batch, stats, progress):
+    inserted = db.session.execute(insert, batch).rowcount
+    db.session.commit()
+    stats.imported += inserted
+    stats.duplicates += len(batch) - inserted
+    if progress is not None:
+        progress(stats)
@@ -0,0 +1,118 @@
+"""SQLite 数据库维护：在线备份、增量 VACUUM、统计信息和完整性检查，供 flask db-backup 和 db-maintain 使用"""
+import os
+import sqlite3
+import time
+
+from watchlist import db
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def sqlite_connection():
+    """返回连接池中的一个 DBAPI 连接（sqlite3.Connection），用完后调用 close() 归还"""
+    if db.engine.dialect.name != 'sqlite':
+        raise RuntimeError('Only SQLite databases are supported.')
+    return db.engine.raw_connection()
+
+
+def backup_database(target, pages=256, sleep=0.05, progress=None):
+    """用 SQLite 在线备份 API 把数据库复制到 target 文件。
+
+    每一步只复制 pages 页，两步之间休息 sleep 秒，源数据库只在复制的那一小段时间内加读锁，
+    网站在备份期间可以继续读写；备份期间其他连接修改了数据库时，SQLite 会重新复制被修改的页。
+    先写入临时文件，完成后再改名，target 不会是复制到一半的文件。返回 (复制的页数, 耗时秒数)。
+    """
+    tmp = target + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    started_at = time.perf_counter()
+    raw = sqlite_connection()
+    try:
+        destination = sqlite3.connect(tmp)
+        try:
+            raw.driver_connection.backup(destination, pages=pages, sleep=sleep, progress=progress)
+            total = destination.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            destination.close()
+    finally:
+        raw.close()
+    os.replace(tmp, target)
+    return total, time.perf_counter() - started_at
+
+
+class MaintenanceReport(object):
+    """db-maintain 每一步的结果：(名称, 耗时秒数, 说明)，前后的页数，以及 VACUUM 回收的页数"""
+
+    def __init__(self, page_size, pages_before, free_before):
+        self.page_size = page_size
+        self.pages_before = pages_before
+        self.free_before = free_before
+        self.pages_after = pages_before
+        self.free_after = free_before
+        # 只统计 VACUUM 这一步，之后的 ANALYZE 会为 sqlite_stat* 表分配新页，不能用前后页数之差
+        self.pages_reclaimed = 0
+        self.steps = []
+        self.integrity_errors = []
+
+
+def page_stats(connection):
+    return tuple(connection.execute('PRAGMA %s' % name).fetchone()[0]
+                 for name in ('page_size', 'page_count', 'freelist_count'))
+
+
+def maintain_database(vacuum_pages=0, full_vacuum=False, analysis_limit=1000, quick_check=False):
+    """依次执行增量 VACUUM、ANALYZE 和 PRAGMA optimize、完整性检查和 WAL 检查点，返回 MaintenanceReport。
+
+    数据库不是 auto_vacuum=INCREMENTAL 模式时，只有 full_vacuum 为 True 才执行一次完整的 VACUUM
+    （期间会阻塞写操作）并切换到增量模式，以后的维护只需要增量 VACUUM。vacuum_pages 为 0 表示回收全部空闲页。
+    """
+    raw = sqlite_connection()
+    connection = raw.driver_connection
+    # VACUUM 不能在事务中执行，维护期间使用自动提交模式，结束后恢复
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        page_size, pages, free = page_stats(connection)
+        report = MaintenanceReport(page_size, pages, free)
+
+        started_at = time.perf_counter()
+        auto_vacuum = connection.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+            connection.execute('PRAGMA incremental_vacuum(%d)' % max(int(vacuum_pages), 0)).fetchall()
+            detail = 'incremental'
+        elif full_vacuum:
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.execute('VACUUM')
+            detail = 'full, switched to auto_vacuum=INCREMENTAL'
+        else:
+            detail = 'skipped, auto_vacuum is off (run once with --full to enable incremental vacuum)'
+        report.pages_reclaimed = max(pages - page_stats(connection)[1], 0)
+        report.steps.append(('vacuum', time.perf_counter() - started_at, detail))
+
+        started_at = time.perf_counter()
+        # analysis_limit 限制 ANALYZE 在每个索引中读取的行数，大表上也能很快完成，0 表示读取全部
+        connection.execute('PRAGMA analysis_limit = %d' % max(int(analysis_limit), 0))
+        connection.execute('ANALYZE')
+        connection.execute('PRAGMA optimize')
+        report.steps.append(('analyze', time.perf_counter() - started_at,
+                             'analysis_limit=%d' % analysis_limit))
+
+        started_at = time.perf_counter()
+        check = 'quick_check' if quick_check else 'integrity_check'
+        rows = [row[0] for row in connection.execute('PRAGMA %s' % check)]
+        if rows != ['ok']:
+            report.integrity_errors = rows
+        report.steps.append((check, time.perf_counter() - started_at,
+                             'ok' if rows == ['ok'] else '%d problems' % len(rows)))
+
+        started_at = time.perf_counter()
+        # WAL 模式下回收的页和统计信息先写入 WAL 文件，检查点之后数据库文件才真正变小
+        busy, log, checkpointed = connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        report.steps.append(('checkpoint', time.perf_counter() - started_at,
+                             'busy' if busy else '%d frames' % max(checkpointed, 0)))
+
+        page_size, report.pages_after, report.free_after = page_stats(connection)
+    finally:
+        connection.isolation_level = isolation_level
+        raw.close()
+    return report
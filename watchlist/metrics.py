@@ -0,0 +1,202 @@
+"""请求监控：按端点统计响应时间、SQL 查询、模板渲染时间和响应大小，以 Prometheus 文本格式输出。
+
+指标保存在进程内存中，多 worker 部署时每个进程分别统计，由 Prometheus 按实例抓取后汇总。
+"""
+import threading
+import time
+from functools import partial
+
+from flask import Blueprint, Response, current_app, has_request_context, request
+from flask.signals import before_render_template, signals_available, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from watchlist import app_extension
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# 直方图的上界，时间单位为秒，大小单位为字节
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram(object):
+    """按标签分组的累积直方图"""
+
+    def __init__(self, name, help, buckets, labels):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += 1
+        series[2] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for label_values, (counts, count, total) in sorted(self._series.items()):
+            labels = ','.join('%s="%s"' % (k, escape(v)) for k, v in zip(self.labels, label_values))
+            prefix = labels + ',' if labels else ''
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, bound, bucket_count))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (self.name, prefix, count))
+            lines.append('%s_sum{%s} %s' % (self.name, labels, repr(float(total))))
+            lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return lines
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry(object):
+    """一个程序的全部指标，读写都在锁内进行"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_duration = Histogram(
+            'watchlist_request_duration_seconds', 'Time spent handling a request.',
+            LATENCY_BUCKETS, ('endpoint', 'method', 'status'))
+        self.sql_queries = Histogram(
+            'watchlist_request_sql_queries', 'Number of SQL statements executed per request.',
+            QUERY_BUCKETS, ('endpoint',))
+        self.sql_duration = Histogram(
+            'watchlist_request_sql_duration_seconds', 'Time spent executing SQL per request.',
+            LATENCY_BUCKETS, ('endpoint',))
+        self.template_duration = Histogram(
+            'watchlist_template_render_seconds', 'Time spent rendering a template.',
+            LATENCY_BUCKETS, ('template',))
+        self.response_size = Histogram(
+            'watchlist_response_size_bytes', 'Size of response bodies with a known length.',
+            SIZE_BUCKETS, ('endpoint',))
+
+    def observe(self, histogram, value, *label_values):
+        with self._lock:
+            histogram.observe(value, *label_values)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for histogram in (self.request_duration, self.sql_queries, self.sql_duration,
+                              self.template_duration, self.response_size):
+                lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+def registry():
+    """返回当前程序的指标，第一次使用时创建"""
+    return app_extension('metrics', lambda app: Registry())
+
+
+STATS_KEY = 'watchlist.request_stats'
+
+
+class RequestStats(object):
+    """一个请求内的统计"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = []  # 只在开启慢请求日志时记录
+        self.templates = []  # 正在渲染的模板的开始时间
+
+
+def request_stats():
+    # 保存在 WSGI environ 中而不是 g 中：流式响应在视图返回之后才渲染模板，
+    # stream_with_context 重新推送请求上下文时会创建新的程序上下文和 g
+    if has_request_context():
+        return request.environ.get(STATS_KEY)
+    return None
+
+
+# 监听所有引擎，不在请求中执行的语句（例如命令）不统计
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if request_stats() is not None:
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats()
+    started = conn.info.get('query_started_at')
+    if stats is None or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    stats.sql_count += 1
+    stats.sql_time += elapsed
+    if current_app.config['METRICS_SLOW_REQUEST']:
+        stats.statements.append((elapsed, statement))
+
+
+def on_before_render_template(app, template, context, **extra):
+    stats = request_stats()
+    if stats is not None:
+        stats.templates.append(time.perf_counter())
+
+
+def on_template_rendered(app, template, context, **extra):
+    stats = request_stats()
+    if stats is not None and stats.templates:
+        elapsed = time.perf_counter() - stats.templates.pop()
+        metrics = registry()
+        metrics.observe(metrics.template_duration, elapsed, template.name or '<string>')
+
+
+# 模板信号依赖 blinker，没有安装时不统计模板渲染时间
+if signals_available:
+    before_render_template.connect(on_before_render_template)
+    template_rendered.connect(on_template_rendered)
+
+
+@metrics_bp.before_app_request
+def start_request():
+    request.environ[STATS_KEY] = RequestStats()
+
+
+@metrics_bp.after_app_request
+def record_request(response):
+    stats = request.environ.get(STATS_KEY)
+    if stats is None:
+        return response
+    finish = partial(finish_request, stats, registry(), current_app.logger,
+                     current_app.config['METRICS_SLOW_REQUEST'], request.endpoint or '<unmatched>',
+                     request.method, request.full_path.rstrip('?'), response.status_code, response.content_length)
+    if response.is_streamed:
+        # 流式响应的模板渲染和其中的查询在发送响应体时才执行，发送完毕关闭响应时再记录
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
+
+def finish_request(stats, metrics, logger, threshold, endpoint, method, path, status, content_length):
+    """记录一个请求的指标，可能在请求上下文已经结束后调用，所以需要的值都由参数传入"""
+    elapsed = time.perf_counter() - stats.started_at
+    metrics.observe(metrics.request_duration, elapsed, endpoint, method, status)
+    metrics.observe(metrics.sql_queries, stats.sql_count, endpoint)
+    metrics.observe(metrics.sql_duration, stats.sql_time, endpoint)
+    # 流式响应的长度未知，不统计
+    if content_length is not None:
+        metrics.observe(metrics.response_size, content_length, endpoint)
+
+    if threshold and elapsed >= threshold:
+        lines = ['%.1fms  %s' % (seconds * 1000, ' '.join(statement.split())) for seconds, statement in stats.statements]
+        logger.warning('Slow request %s %s took %.1fms with %d SQL statements (%.1fms):\n%s',
+                       method, path, elapsed * 1000, stats.sql_count, stats.sql_time * 1000, '\n'.join(lines))
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    return Response(registry().render(), content_type='text/plain; version=0.0.4; charset=utf-8')
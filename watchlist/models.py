@@ -1,4 +1,11 @@
+import re
+from datetime import datetime
+
+from flask import current_app, has_app_context
 from flask_login import UserMixin
+from sqlalchemy import event, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from watchlist import db
@@ -7,17 +14,172 @@ from watchlist import db
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)  # 主键
     name = db.Column(db.String(20))
-    username = db.Column(db.String(20))
+    username = db.Column(db.String(20), unique=True)  # 登录和 /user/<username> 按用户名查找
     password_hash = db.Column(db.String(128))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # 哈希算法和迭代次数由 PASSWORD_HASH_METHOD 配置，旧参数的哈希会在登录时更新
+        if has_app_context():
+            self.password_hash = generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'],
+                                                        salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+        else:
+            self.password_hash = generate_password_hash(password)
 
     def validate_password(self, password):
         return check_password_hash(self.password_hash, password)
 
 
 class Movie(db.Model):
+    # 所有查询都限定在一个用户的清单内，索引都以 user_id 开头，一个用户的页面只扫描他自己的记录；
+    # 后两个与各排序方式对应，按年份范围筛选和排序、翻页时都可以直接扫描索引
+    __table_args__ = (
+        db.Index('ix_movie_user_id_id', 'user_id', 'id'),
+        db.Index('ix_movie_user_year_id', 'user_id', 'year', 'id'),
+        db.Index('ix_movie_user_title_id', 'user_id', 'title', 'id'),
+        # 同一个清单中不允许大小写和空白不同的同名同年电影，写入时用 ON CONFLICT / OR IGNORE 处理冲突
+        db.Index('uq_movie_user_title_key_year', 'user_id', 'title_key', 'year', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
-    year = db.Column(db.String(4))
\ No newline at end of file
+    title_key = db.Column(db.String(60))  # normalize_title(title)，判断重复用
+    year = db.Column(db.Integer)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 电影所属的用户
+
+    user = db.relationship('User', backref=db.backref('movies', lazy='dynamic'))
+
+    # 主页支持的排序方式：排序列（最后一列是主键）和是否倒序
+    sort_orders = {
+        'year': (('year', 'id'), False),
+        '-year': (('year', 'id'), True),
+        'title': (('title', 'id'), False),
+    }
+    default_sort = 'year'
+
+    @classmethod
+    def sort_columns(cls, sort):
+        names, descending = cls.sort_orders[sort]
+        return [getattr(cls, name) for name in names], descending
+
+    @validates('title')
+    def update_title_key(self, key, title):
+        self.title_key = normalize_title(title)
+        return title
+
+
+def normalize_title(title):
+    """标题的比较键：合并连续空白并忽略大小写（casefold 也能处理 ß 等非 ASCII 字符）"""
+    return ' '.join(title.split()).casefold() if title is not None else None
+
+
+def movie_ddl(statements):
+    """movie 表上的 SQLite 触发器和虚拟表：随 movie 表一起创建，返回为已经存在的 movie 表补建它们的函数（flask initdb 调用）。
+
+    搜索索引、变更日志和年份统计都由触发器维护，视图、写队列、API 和批量导入不需要额外处理。
+    """
+    @event.listens_for(Movie.__table__, 'after_create')
+    def create(target, connection, **kw):
+        if connection.dialect.name == 'sqlite':
+            for statement in statements:
+                connection.execute(text(statement))
+
+    def install():
+        if db.engine.dialect.name == 'sqlite':
+            for statement in statements:
+                db.session.execute(text(statement))
+    return install
+
+
+_year_pattern = re.compile(r'[0-9]{1,4}')
+
+
+def validate_movie(title, year):
+    """检查电影标题和年份是否有效，主页表单、编辑表单和批量导入共用，年份需要是 1 到 4 位数字"""
+    # 不用 str.isdigit()，它对 '²' 等 Unicode 数字也返回 True，但 int() 无法转换
+    return bool(title) and len(title) <= 60 and bool(year) and _year_pattern.fullmatch(year) is not None
+
+
+def create_movie(user_id, title, year):
+    """添加一部电影，返回 (id, 'created')；清单中已有同名同年的电影时不插入，返回 (已有电影的 id, 'duplicate')。
+
+    只修改会话，由 writequeue.run_write() 负责提交。重复判断由唯一索引在同一条 INSERT 语句中完成，
+    不需要先查询，也不会在并发写入时漏掉。
+    """
+    key = normalize_title(title)
+    result = db.session.execute(sqlite_insert(Movie.__table__).on_conflict_do_nothing().values(
+        title=title, title_key=key, year=year, user_id=user_id))
+    if result.rowcount:
+        return result.lastrowid, 'created'
+    return db.session.query(Movie.id).filter_by(user_id=user_id, title_key=key, year=year).scalar(), 'duplicate'
+
+
+def update_movie(user_id, movie_id, title, year):
+    """修改 user_id 的一部电影，返回 updated；改成清单中已有的同名同年电影时不修改，返回 duplicate；
+    没有这部电影时返回 not_found
+    """
+    statement = Movie.__table__.update().prefix_with('OR IGNORE') \
+        .where(Movie.id == movie_id, Movie.user_id == user_id) \
+        .values(title=title, title_key=normalize_title(title), year=year)
+    if db.session.execute(statement).rowcount:
+        return 'updated'
+    exists = db.session.query(Movie.id).filter_by(id=movie_id, user_id=user_id).first() is not None
+    return 'duplicate' if exists else 'not_found'
+
+
+def delete_movie(user_id, movie_id):
+    """删除 user_id 的一部电影，返回是否找到了这部电影"""
+    return Movie.query.filter_by(id=movie_id, user_id=user_id).delete(synchronize_session=False) > 0
+
+
+class MovieChange(db.Model):
+    """电影的变更日志，只追加不修改，由 watchlist/changes.py 中的触发器在 movie 表增删改时写入。
+
+    id 就是客户端保存的游标：/changes 事件流的事件 id 和 /api/changes 的 since 参数。
+    """
+    __table_args__ = (
+        db.Index('ix_movie_change_user_id_id', 'user_id', 'id'),
+        {'sqlite_autoincrement': True},  # 游标只增不减，id 不会被重新使用
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer)
+    movie_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # create、update 或 delete
+    title = db.Column(db.String(60))  # 删除时为空
+    year = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+
+    def to_dict(self):
+        movie = {'id': self.movie_id}
+        if self.op != 'delete':
+            movie.update(title=self.title, year=self.year)
+        return {'id': self.id, 'op': self.op, 'movie': movie}
+
+
+class MovieYearStat(db.Model):
+    """每个用户每年的电影数量，由 watchlist/stats.py 中的触发器随 movie 表增删改更新，flask rebuild-stats 可以重建"""
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DataVersion(db.Model):
+    """观影清单的数据版本号，每次写操作加一，用来生成 ETag 和 Last-Modified"""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+def bump_version():
+    """在当前事务中把数据版本号加一，需要在 db.session.commit() 之前调用"""
+    now = datetime.utcnow()
+    updated = DataVersion.query.filter_by(id=1).update(
+        {DataVersion.version: DataVersion.version + 1, DataVersion.updated_at: now}, synchronize_session=False)
+    if not updated:
+        db.session.add(DataVersion(id=1, version=1, updated_at=now))
+
+
+def current_version():
+    """返回 (version, updated_at)，还没有任何写操作时返回 (0, None)"""
+    row = db.session.query(DataVersion.version, DataVersion.updated_at).filter_by(id=1).first()
+    return tuple(row) if row is not None else (0, None)
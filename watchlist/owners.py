@@ -0,0 +1,19 @@
+"""当前请求显示谁的观影清单，视图、API、统计和变更推送共用"""
+from flask import request
+from flask_login import current_user
+
+from watchlist.cache import get_user
+from watchlist.models import User
+
+
+def page_owner():
+    """当前显示谁的观影清单：登录后是自己的，未登录时是站点默认用户（第一个用户）的"""
+    if current_user.is_authenticated:
+        return current_user._get_current_object()
+    return get_user()
+
+
+def request_owner():
+    """?user=<username> 指定的用户，没有这个用户时返回 404；不指定时是 page_owner()"""
+    username = request.args.get('user')
+    return User.query.filter_by(username=username).first_or_404() if username else page_owner()
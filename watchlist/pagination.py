@@ -0,0 +1,73 @@
+"""基于游标（keyset）的分页工具"""
+from sqlalchemy import tuple_
+
+from watchlist import db
+
+# SQLite 的 INTEGER 是 64 位有符号整数，超出这个范围的参数在绑定时抛出 OverflowError
+MAX_INTEGER = 2 ** 63 - 1
+
+
+class KeysetPage(object):
+    """一页查询结果，next_cursor/prev_cursor 分别用作 ?after= 和 ?before= 参数"""
+
+    def __init__(self, items, has_next=False, has_prev=False):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        return self.items[-1].id if self.items else None
+
+    @property
+    def prev_cursor(self):
+        return self.items[0].id if self.items else None
+
+
+def cursor_param(value):
+    """用作 request.args.get() 的 type 解析 ?after=/?before= 游标，超出整数范围的游标和无效的游标一样被忽略，回到第一页"""
+    value = int(value)
+    if not -MAX_INTEGER <= value <= MAX_INTEGER:
+        raise ValueError('Cursor out of range.')
+    return value
+
+
+def keyset_paginate(query, columns, per_page, after=None, before=None, descending=False):
+    """按 columns 排序并分页，columns 的最后一列必须是主键，保证排序唯一。
+
+    游标是边界记录的主键，按多列排序时先用主键查出边界记录的排序键，
+    再用 WHERE (col1, col2) > (:v1, :v2) LIMIT per_page + 1 取数据，不使用 OFFSET，
+    配合与 columns 相同的复合索引，不管翻到第几页，每页的代价都只和 per_page 有关。
+    """
+    columns = list(columns)
+    key = tuple_(*columns) if len(columns) > 1 else columns[0]
+    forward = [c.desc() if descending else c.asc() for c in columns]
+    backward = [c.asc() if descending else c.desc() for c in columns]
+
+    if before is not None:
+        bound = _cursor_key(columns, before)
+        if bound is not None:
+            # 向前翻页：反向取出 before 之前的记录，再反转回正序
+            query = query.filter(key > bound if descending else key < bound)
+            rows = query.order_by(*backward).limit(per_page + 1).all()
+            items = rows[:per_page]
+            items.reverse()
+            return KeysetPage(items, has_next=True, has_prev=len(rows) > per_page)
+        after = None
+
+    if after is not None:
+        bound = _cursor_key(columns, after)
+        if bound is not None:
+            query = query.filter(key < bound if descending else key > bound)
+        else:
+            after = None
+    rows = query.order_by(*forward).limit(per_page + 1).all()
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_prev=after is not None)
+
+
+def _cursor_key(columns, cursor):
+    """返回游标记录的排序键，游标记录不存在时返回 None（回到第一页）"""
+    if len(columns) == 1:
+        return cursor
+    row = db.session.query(*columns).filter(columns[-1] == cursor).first()
+    return tuple_(*row) if row is not None else None
@@ -0,0 +1,66 @@
+"""基于 SQLite FTS5 的电影标题全文搜索"""
+import re
+
+from sqlalchemy import event, text
+
+from watchlist import db
+from watchlist.models import Movie, movie_ddl
+
+# movie_fts 是外部内容（external content）表，只保存索引，标题仍然存放在 movie 表中
+SCHEMA = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5(
+        title, content='movie', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS movie_fts_insert AFTER INSERT ON movie BEGIN
+        INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_fts_delete AFTER DELETE ON movie BEGIN
+        INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_fts_update AFTER UPDATE OF title ON movie BEGIN
+        INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title);
+    END""",
+)
+
+SEARCH_SQL = """SELECT movie.* FROM movie_fts JOIN movie ON movie.id = movie_fts.rowid
+    WHERE movie_fts MATCH :query AND movie.user_id IS :user_id
+    ORDER BY movie_fts.rank LIMIT :limit OFFSET :offset"""
+
+
+install_index = movie_ddl(SCHEMA)
+
+
+@event.listens_for(Movie.__table__, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    # 触发器会随 movie 表一起删除，虚拟表需要手动删除
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text('DROP TABLE IF EXISTS movie_fts'))
+
+
+def rebuild_index():
+    """创建（如果不存在）并根据 movie 表重建全文索引"""
+    install_index()
+    db.session.execute(text("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+def match_expression(q):
+    """把用户输入转换成 FTS5 查询：每个词都按前缀匹配，所有词都要出现，忽略 FTS5 的特殊语法"""
+    terms = re.findall(r'\w+', q)
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+def search_movies(q, page=1, per_page=20, user_id=None):
+    """在 user_id 的清单中搜索，按相关度排序返回 (当前页电影列表, 是否有下一页)"""
+    expression = match_expression(q)
+    if not expression:
+        return [], False
+    offset = (page - 1) * per_page
+    if db.engine.dialect.name == 'sqlite':
+        statement = text(SEARCH_SQL).bindparams(query=expression, user_id=user_id, limit=per_page + 1, offset=offset)
+        movies = Movie.query.from_statement(statement).all()
+    else:
+        # 其他数据库没有 FTS5，退化为 LIKE 查询
+        movies = Movie.query.filter(Movie.user_id == user_id, Movie.title.ilike('%' + q + '%')).order_by(Movie.id) \
+            .limit(per_page + 1).offset(offset).all()
+    return movies[:per_page], len(movies) > per_page
@@ -0,0 +1,105 @@
+"""配置文件，create_app() 根据配置名称选择其中的配置类"""
+import os
+
+basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+class BaseConfig(object):
+    SECRET_KEY = os.getenv('SECRET_KEY', 'dev')
+    SQLALCHEMY_DATABASE_URI = 'sqlite:////' + os.path.join(basedir, os.getenv('DATABASE_FILE', 'db.sqlite3'))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # SQLite 连接配置，见 watchlist/engine.py：default 或 wal，单项 pragma 可以分别覆盖
+    SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'wal')
+    SQLITE_BUSY_TIMEOUT = os.getenv('SQLITE_BUSY_TIMEOUT')  # 毫秒
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS')
+    SQLITE_CACHE_SIZE = os.getenv('SQLITE_CACHE_SIZE')
+    SQLITE_MMAP_SIZE = os.getenv('SQLITE_MMAP_SIZE')
+    SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', 5))  # 每个 worker 进程的连接池大小
+    SQLITE_MAX_OVERFLOW = int(os.getenv('SQLITE_MAX_OVERFLOW', 10))
+
+    MOVIES_PER_PAGE = int(os.getenv('MOVIES_PER_PAGE', 20))  # 主页每页显示的电影条目数
+    STREAM_BUFFER_SIZE = 8192  # 流式渲染页面时每次发送的最小字节数
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 0))  # 进程级用户缓存的秒数，0 表示只在请求内缓存
+    # 未登录用户主页的页面缓存：null（不缓存）、lru（进程内）或 filesystem（多进程共享）
+    PAGE_CACHE_TYPE = os.getenv('PAGE_CACHE_TYPE', 'null')
+    PAGE_CACHE_DIR = os.getenv('PAGE_CACHE_DIR')  # 默认为 instance/page-cache
+    PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', 128))
+    PAGE_CACHE_TIMEOUT = int(os.getenv('PAGE_CACHE_TIMEOUT', 0))  # 秒，0 表示只靠写操作失效
+    # 渲染好的错误页面的缓存秒数，本进程修改用户名字时立即失效，其他 worker 进程最多在这段时间后更新
+    ERROR_PAGE_CACHE_TTL = int(os.getenv('ERROR_PAGE_CACHE_TTL', 300))
+    # Jinja 字节码缓存（见 watchlist/templating.py）：目录默认为 instance/template-cache，所有 worker 进程共享；
+    # TEMPLATE_WARMUP 让程序启动时就加载全部模板
+    TEMPLATE_BYTECODE_CACHE = os.getenv('TEMPLATE_BYTECODE_CACHE', '1') == '1'
+    TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR')
+    TEMPLATE_WARMUP = os.getenv('TEMPLATE_WARMUP', '1') == '1'
+    # flask build-assets 的输出目录（static 下的子目录）和带哈希文件的缓存时间
+    ASSETS_DIR = 'dist'
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+    # 响应压缩：只压缩以下类型且大于 COMPRESS_MIN_SIZE 字节的响应，流式响应总是逐块压缩
+    COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', '1') == '1'
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/csv', 'application/json',
+                          'application/x-ndjson', 'application/javascript', 'image/svg+xml')
+    # /changes 事件流：没有本进程的提交通知时每隔多少秒查询一次新变更、空闲时的心跳间隔、
+    # 每条连接的最长时间（之后浏览器带着 Last-Event-ID 重连），以及每次最多读取的变更数
+    CHANGES_POLL_INTERVAL = float(os.getenv('CHANGES_POLL_INTERVAL', 1))
+    CHANGES_HEARTBEAT = 15
+    CHANGES_STREAM_TIMEOUT = int(os.getenv('CHANGES_STREAM_TIMEOUT', 300))
+    CHANGES_BATCH_SIZE = 500
+    API_MAX_PER_PAGE = 500  # /api/movies 每页最多返回的条目数
+    API_MAX_BATCH = int(os.getenv('API_MAX_BATCH', 5000))  # 批量接口一次请求最多处理的条目数
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))  # 导出时每次从游标读取的行数
+
+    # 密码哈希参数（werkzeug 的 method 格式），修改后旧的哈希会在用户下次登录时自动更新
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    PASSWORD_SALT_LENGTH = 16
+    # 校验密码的线程池：同时计算的哈希数和最多排队的请求数，排队超过上限时返回 503
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 16))
+    PASSWORD_HASH_TIMEOUT = 10  # 秒
+    # 每个客户端的登录尝试令牌桶：最多连续尝试 BURST 次，之后每秒恢复 RATE 次，BURST 为 0 表示不限制
+    LOGIN_THROTTLE_RATE = float(os.getenv('LOGIN_THROTTLE_RATE', 0.2))
+    LOGIN_THROTTLE_BURST = int(os.getenv('LOGIN_THROTTLE_BURST', 10))
+
+    # 写队列（见 watchlist/writequeue.py）：表单的写操作交给一个写线程，每 BATCH_MS 毫秒或每 BATCH_SIZE 个操作提交一次；
+    # ACK 为 commit 时请求等到提交后返回，为 queued 时入队后立即返回，READ_YOUR_WRITES 让同一会话之后的请求等待自己的修改
+    WRITE_QUEUE_ENABLED = os.getenv('WRITE_QUEUE_ENABLED', '0') == '1'
+    WRITE_QUEUE_BATCH_MS = float(os.getenv('WRITE_QUEUE_BATCH_MS', 5))
+    WRITE_QUEUE_BATCH_SIZE = int(os.getenv('WRITE_QUEUE_BATCH_SIZE', 500))
+    WRITE_QUEUE_MAX = int(os.getenv('WRITE_QUEUE_MAX', 10000))  # 排队的操作超过上限时返回 503
+    WRITE_QUEUE_ACK = os.getenv('WRITE_QUEUE_ACK', 'commit')
+    WRITE_QUEUE_READ_YOUR_WRITES = os.getenv('WRITE_QUEUE_READ_YOUR_WRITES', '1') == '1'
+    WRITE_QUEUE_TIMEOUT = 10  # 秒
+
+    # /metrics 端点和请求监控，慢请求日志的阈值单位为秒，0 表示关闭
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+    METRICS_SLOW_REQUEST = float(os.getenv('METRICS_SLOW_REQUEST', 0))
+
+    # flask startup-report 使用的冷启动时间预算，单位毫秒
+    STARTUP_TIME_BUDGET = int(os.getenv('STARTUP_TIME_BUDGET', 1000))
+
+
+class DevelopmentConfig(BaseConfig):
+    pass
+
+
+class TestingConfig(BaseConfig):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'  # 测试中不需要耗时的哈希
+    TEMPLATE_BYTECODE_CACHE = False  # 不在 instance 目录中写入缓存文件
+    TEMPLATE_WARMUP = False  # 每个测试都会创建程序，不预先加载全部模板
+
+
+class ProductionConfig(BaseConfig):
+    pass
+
+
+config = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,76 @@
+"""按年份和年代统计电影数量。
+
+movie_year_stat 是物化的聚合表，每个用户每年一行，随 movie 表的增删改增量更新。/stats 页面和 /api/stats 只读取这张表，
+行数取决于不同年份的个数而不是电影总数，不需要每次在整个 movie 表上 GROUP BY。
+"""
+from flask import Blueprint, render_template
+from sqlalchemy import text
+
+from watchlist import db
+from watchlist.models import MovieYearStat, movie_ddl
+from watchlist.owners import request_owner
+
+stats_bp = Blueprint('stats', __name__)
+
+# user_id 或 year 为空的电影不计入统计
+SCHEMA = (
+    """CREATE TRIGGER IF NOT EXISTS movie_year_stat_insert AFTER INSERT ON movie
+    WHEN new.user_id IS NOT NULL AND new.year IS NOT NULL BEGIN
+        INSERT INTO movie_year_stat(user_id, year, count) VALUES (new.user_id, new.year, 1)
+        ON CONFLICT(user_id, year) DO UPDATE SET count = count + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_year_stat_delete AFTER DELETE ON movie
+    WHEN old.user_id IS NOT NULL AND old.year IS NOT NULL BEGIN
+        UPDATE movie_year_stat SET count = count - 1 WHERE user_id = old.user_id AND year = old.year;
+        DELETE FROM movie_year_stat WHERE user_id = old.user_id AND year = old.year AND count <= 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_year_stat_update AFTER UPDATE OF user_id, year ON movie BEGIN
+        UPDATE movie_year_stat SET count = count - 1 WHERE user_id = old.user_id AND year = old.year;
+        DELETE FROM movie_year_stat WHERE user_id = old.user_id AND year = old.year AND count <= 0;
+        INSERT INTO movie_year_stat(user_id, year, count)
+        SELECT new.user_id, new.year, 1 WHERE new.user_id IS NOT NULL AND new.year IS NOT NULL
+        ON CONFLICT(user_id, year) DO UPDATE SET count = count + 1;
+    END""",
+)
+
+REBUILD_SQL = """INSERT INTO movie_year_stat(user_id, year, count)
+    SELECT user_id, year, count(*) FROM movie WHERE user_id IS NOT NULL AND year IS NOT NULL
+    GROUP BY user_id, year"""
+
+
+install_triggers = movie_ddl(SCHEMA)
+
+
+def rebuild_stats():
+    """创建（如果不存在）触发器并根据 movie 表重新计算全部统计，返回统计的行数。
+
+    在一个事务中执行，其他连接在提交之前读到的还是旧的统计。
+    """
+    install_triggers()
+    MovieYearStat.query.delete(synchronize_session=False)
+    db.session.execute(text(REBUILD_SQL))
+    db.session.commit()
+    return MovieYearStat.query.count()
+
+
+def year_stats(user_id):
+    """返回 (total, years, decades)，years 和 decades 都是按年份排序的 [(年份或年代, 数量)] 列表"""
+    years = db.session.query(MovieYearStat.year, MovieYearStat.count) \
+        .filter(MovieYearStat.user_id == user_id).order_by(MovieYearStat.year).all()
+    decades = []
+    for year, count in years:
+        decade = year // 10 * 10
+        if decades and decades[-1][0] == decade:
+            decades[-1] = (decade, decades[-1][1] + count)
+        else:
+            decades.append((decade, count))
+    return sum(count for year, count in years), [tuple(row) for row in years], decades
+
+
+@stats_bp.route('/stats')
+def stats():
+    owner = request_owner()
+    total, years, decades = year_stats(owner.id if owner is not None else None)
+    max_count = max([count for decade, count in decades] or [0])
+    return render_template('stats.html', user=owner, total=total, years=years, decades=decades,
+                           max_count=max_count)
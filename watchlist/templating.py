@@ -0,0 +1,67 @@
+"""模板预编译：Jinja 字节码缓存和启动时的模板预热。
+
+每个新的 worker 进程第一次渲染某个模板时都要解析模板并编译成 Python 代码，部署或扩容之后最先到达的请求因此变慢。
+开启 TEMPLATE_BYTECODE_CACHE 后编译结果保存在 TEMPLATE_CACHE_DIR（默认 instance/template-cache）中，
+同一台机器上的所有 worker 共享，只有第一个进程需要编译；缓存键包含模板源码的校验和，修改模板后自动重新编译。
+开启 TEMPLATE_WARMUP 时程序启动时就加载全部模板，第一个请求不再需要编译或读取缓存文件。
+flask template-report 输出每个模板的编译耗时和从字节码缓存加载的耗时，同时填充字节码缓存，可以在部署时先运行一次。
+"""
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def bytecode_cache(app):
+    """返回 app 的字节码缓存，没有开启时返回 None"""
+    if not app.config['TEMPLATE_BYTECODE_CACHE']:
+        return None
+    directory = app.config['TEMPLATE_CACHE_DIR'] or os.path.join(app.instance_path, 'template-cache')
+    os.makedirs(directory, exist_ok=True)
+    return FileSystemBytecodeCache(directory)
+
+
+def template_names(env):
+    return env.list_templates(filter_func=lambda name: name.endswith('.html'))
+
+
+def warm_templates(app):
+    """把全部模板加载到 Jinja 环境的模板缓存中，返回 (模板数, 耗时秒数)"""
+    started_at = time.perf_counter()
+    names = template_names(app.jinja_env)
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names), time.perf_counter() - started_at
+
+
+def template_timings(env, cache):
+    """逐个编译模板，返回 [(模板名, 编译秒数, 从缓存加载的秒数, 运行前是否已经缓存)]。
+
+    cache 为 None 时加载耗时也是 None；缓存中没有的模板编译后写入缓存。
+    """
+    timings = []
+    for name in template_names(env):
+        source, filename, _ = env.loader.get_source(env, name)
+        started_at = time.perf_counter()
+        code = env.compile(source, name, filename)
+        compile_seconds = time.perf_counter() - started_at
+        load_seconds, cached = None, False
+        if cache is not None:
+            bucket = cache.get_bucket(env, name, filename, source)
+            cached = bucket.code is not None
+            if not cached:
+                bucket.code = code
+                cache.set_bucket(bucket)
+            started_at = time.perf_counter()
+            cache.get_bucket(env, name, filename, source)
+            load_seconds = time.perf_counter() - started_at
+        timings.append((name, compile_seconds, load_seconds, cached))
+    return timings
+
+
+def init_templates(app):
+    """在注册完蓝本之后调用：设置字节码缓存，需要时预热模板"""
+    app.jinja_env.bytecode_cache = bytecode_cache(app)
+    if app.config['TEMPLATE_WARMUP']:
+        count, elapsed = warm_templates(app)
+        app.logger.debug('Loaded %d templates in %.1fms', count, elapsed * 1000)
@@ -1,99 +1,335 @@
-from flask import request, flash, redirect, url_for, render_template
+import hashlib
+import math
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime, timezone
+
+from flask import request, flash, redirect, url_for, render_template, session, make_response, Response, \
+    stream_with_context, stream_template, get_flashed_messages, Blueprint, current_app, abort
 from flask_login import login_user, login_required, logout_user, current_user
+from sqlalchemy import func
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.urls import url_encode
+
+from watchlist import db
+from watchlist.auth import PoolBusy, login_throttle, verify_password
+from watchlist.cache import invalidate_user_cache, page_cache
+from watchlist.compression import strip_encoding
+from watchlist.models import User, Movie, bump_version, create_movie, current_version, delete_movie, update_movie, \
+    validate_movie
+from watchlist.owners import page_owner
+from watchlist.pagination import MAX_INTEGER, cursor_param, keyset_paginate
+from watchlist.search import search_movies
+from watchlist.writequeue import run_write
+
+main_bp = Blueprint('main', __name__)
+
+
+@main_bp.app_context_processor
+def inject_user():
+    return dict(user=page_owner())
+
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+def page_validators(*variant):
+    """根据数据版本号生成强 ETag 和 Last-Modified，variant 用来区分同一版本下的不同页面"""
+    version, updated_at = current_version()
+    key = '%s:%s:%s' % (version, updated_at.isoformat() if updated_at else '', ':'.join(map(str, variant)))
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    last_modified = updated_at.replace(tzinfo=timezone.utc, microsecond=0) if updated_at else None
+    return etag, last_modified
 
 
-@app.route('/login', methods=['GET', 'POST'])
+def not_modified(etag, last_modified):
+    """客户端缓存的页面仍然有效时返回 True，If-None-Match 优先于 If-Modified-Since"""
+    if request.if_none_match:
+        # 压缩后的响应 ETag 带有编码后缀，比较时忽略
+        return request.if_none_match.contains(etag) \
+            or any(strip_encoding(tag) == etag for tag in request.if_none_match)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def conditional_response(body, etag, last_modified, status=200):
+    response = make_response(body, status)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True  # 允许缓存，但每次使用前都要向服务器验证
+    return response
+
+
+@main_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         if not username or not password:
             flash('Invalid input.')
-            return redirect(url_for('login'))
-        user = User.query.first()
-        if username == user.username and user.validate_password(password):
+            return redirect(url_for('main.login'))
+        # 每次尝试先从令牌桶取出一个令牌，频繁尝试的客户端在计算哈希之前就被拒绝
+        client = request.remote_addr
+        throttle = login_throttle()
+        retry_after = throttle.consume(client)
+        if retry_after:
+            raise TooManyRequests(retry_after=int(math.ceil(min(retry_after, 3600))))
+        user = User.query.filter_by(username=username).first()
+        valid, new_hash = False, None
+        if user is not None:
+            try:
+                valid, new_hash = verify_password(user, password)
+            except (PoolBusy, FutureTimeout):  # Python 3.11 之前它和内置的 TimeoutError 不是同一个类
+                throttle.refund(client)
+                raise ServiceUnavailable(retry_after=1)
+        if valid:
+            throttle.refund(client)
+            if new_hash is not None:
+                user.password_hash = new_hash  # 哈希参数已经过时，用新参数重新保存
+                db.session.commit()
+                invalidate_user_cache()
             login_user(user)
             flash('Login success.')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         flash('Invalid username or password.')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('login.html')
 
 
-@app.route('/logout')
+@main_bp.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('Goodbye.')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/settings', methods=['GET', 'POST'])
+@main_bp.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     if request.method == 'POST':
         name = request.form['name']
         if not name or len(name) > 20:
             flash('Invalid input.')
-            return redirect(url_for('settings'))
+            return redirect(url_for('main.settings'))
         current_user.name = name
+        bump_version()  # 页面中显示了用户名
         db.session.commit()
+        invalidate_user_cache()
+        page_cache().clear()
         flash('Settings updated.')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     return render_template('settings.html')
 
 
-@app.route('/', methods=['GET', 'POST'])
+@main_bp.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == "POST":
         if not current_user.is_authenticated:  # 如果当前用户未登录
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         title = request.form.get('title')  # 获取表单数据,传入表单中输入字段的name值
         year = request.form.get('year')
-        if not title or not year or len(year) > 4 or len(title) > 60:  # 验证输入数据
+        if not validate_movie(title, year):  # 验证输入数据
             flash('Invalid input.')  # 显示错误提示信息,此函数用来在视图函数里向模板传递提示消息
-            return redirect(url_for('index'))  # 重定向到主页
-        # 保存表单数据到数据库
-        movie = Movie(title=title, year=year)
-        db.session.add(movie)
-        db.session.commit()
-        flash('Movie Item Created.')  # 显示成功创建的提示
-        return redirect(url_for('index'))
+            return redirect(url_for('main.index'))  # 重定向到主页
+        # 保存表单数据到数据库，开启写队列时和其他请求的写操作合并提交
+        result = run_write(create_movie, current_user.id, title, int(year))
+        if result is not None and result[1] == 'duplicate':  # queued 模式下没有结果，重复的电影由唯一索引忽略
+            flash('Movie already in your list.')
+        else:
+            flash('Movie Item Created.')  # 显示成功创建的提示
+        return redirect(url_for('main.index'))
     # 否则是GET请求，返回渲染后的页面
-    user = User.query.first()
-    movies = Movie.query.all()  # 读取所有电影记录
-    return render_template('index.html', user=user, movies=movies)
+    return show_movies(None, 'main.index')
+
+
+@main_bp.route('/user/<username>')
+def user_index(username):
+    """某个用户的观影清单，只有本人登录后才显示编辑按钮"""
+    owner = User.query.filter_by(username=username).first_or_404()
+    return show_movies(owner, 'main.user_index', username=username)
+
+
+def show_movies(owner, endpoint, **view_args):
+    """显示 owner 的观影清单，owner 为 None 时是 page_owner() 的，未登录访客命中页面缓存时不查询站点默认用户"""
+    after = request.args.get('after', type=cursor_param)
+    before = request.args.get('before', type=cursor_param)
+    filters = index_filters()
+    # 有待显示的提示消息时页面内容不固定，不做缓存和条件请求处理
+    if '_flashes' in session:
+        return stream_index(owner or page_owner(), after, before, filters, endpoint, view_args)
+    owner_key = owner.id if owner is not None else current_user.get_id() or 'default'
+    variant = '%s:%s?%s' % (endpoint, owner_key, url_encode(dict(filters, after=after, before=before), sort=True))
+    # 未登录时所有访客看到的页面相同，可以直接返回缓存的页面，缓存中同时保存了 ETag
+    cache_key = None
+    if not current_user.is_authenticated:
+        cache_key = variant
+        cached = page_cache().get(cache_key)
+        if cached is not None:
+            last_modified = cached['last_modified'] and datetime.fromtimestamp(cached['last_modified'], timezone.utc)
+            if not_modified(cached['etag'], last_modified):
+                return conditional_response('', cached['etag'], last_modified, 304)
+            return conditional_response(cached['html'], cached['etag'], last_modified)
+    # 在读取电影记录之前先检查客户端缓存是否仍然有效
+    etag, last_modified = page_validators(variant, current_user.get_id())
+    if not_modified(etag, last_modified):
+        return conditional_response('', etag, last_modified, 304)
+    chunks = stream_index(owner or page_owner(), after, before, filters, endpoint, view_args)
+    if cache_key is not None:
+        # 一边发送一边保存，完整发送后写入页面缓存
+        chunks = cache_chunks(chunks, page_cache(), cache_key,
+                              {'etag': etag, 'last_modified': last_modified and last_modified.timestamp()})
+    return conditional_response(chunks, etag, last_modified)
+
+
+def index_filters():
+    """解析主页的筛选和排序参数，只保留有效且非默认的值，用于生成链接和缓存键"""
+    filters = {}
+    for name in ('year_from', 'year_to'):
+        value = request.args.get(name, type=int)
+        if value is not None and 0 <= value <= 9999:  # 年份最多 4 位，超出范围的值丢弃，也避免绑定时溢出
+            filters[name] = value
+    sort = request.args.get('sort')
+    if sort in Movie.sort_orders and sort != Movie.default_sort:
+        filters['sort'] = sort
+    return filters
+
+
+def filter_clauses(filters):
+    clauses = []
+    if 'year_from' in filters:
+        clauses.append(Movie.year >= filters['year_from'])
+    if 'year_to' in filters:
+        clauses.append(Movie.year <= filters['year_to'])
+    return clauses
+
+
+def movie_page(owner, after, before, filters, per_page):
+    """按 index_filters() 返回的筛选条件查询 owner 的一页电影，主页和 API 共用"""
+    query = Movie.query.filter(Movie.user_id == owner_id(owner), *filter_clauses(filters))
+    # 游标分页，只读取当前页的电影记录，排序和年份范围筛选都由复合索引完成
+    columns, descending = Movie.sort_columns(filters.get('sort', Movie.default_sort))
+    return keyset_paginate(query, columns, per_page, after=after, before=before, descending=descending)
 
 
-@app.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
+def movie_count(owner, filters):
+    """owner 符合筛选条件的电影总数，用 COUNT(*) 在数据库中计算，只扫描 (user_id, year, id) 索引中他的部分"""
+    return db.session.query(func.count(Movie.id)) \
+        .filter(Movie.user_id == owner_id(owner), *filter_clauses(filters)).scalar()
+
+
+def owner_id(owner):
+    return owner.id if owner is not None else None
+
+
+def stream_page(template_name, **context):
+    """流式渲染模板：先发送页面开头，不在内存中拼接整个页面。
+
+    提示消息必须在开始输出之前取出，因为会话在发送响应体之前就已经保存了；
+    Jinja 每次只产生很小的片段，这里合并成至少 STREAM_BUFFER_SIZE 字节再发送，减少写操作和压缩时的刷新次数。
+    """
+    get_flashed_messages()
+    return buffer_chunks(stream_template(template_name, **context), current_app.config['STREAM_BUFFER_SIZE'])
+
+
+def buffer_chunks(chunks, size):
+    buffer, buffered = [], 0
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= size:
+                yield ''.join(buffer)
+                buffer, buffered = [], 0
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        chunks.close()  # 关闭 stream_with_context 的生成器，释放请求上下文
+
+
+def cache_chunks(chunks, cache, key, value):
+    """原样转发 chunks，全部发送完后把完整页面连同 value 一起写入缓存，中途断开时不写入"""
+    parts = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        value['html'] = ''.join(parts)
+        cache.set(key, value)
+    finally:
+        chunks.close()
+
+
+def stream_index(owner, after, before, filters, endpoint, view_args):
+    page = movie_page(owner, after, before, filters, current_app.config['MOVIES_PER_PAGE'])
+    # 翻页链接和筛选表单指向当前页面（主页或 /user/<username>）
+    return stream_page('index.html', user=owner, movies=page.items, page=page, total=movie_count(owner, filters),
+                       filters=filters, endpoint=endpoint, page_args=dict(filters, **view_args),
+                       list_url=url_for(endpoint, **view_args))
+
+
+@main_bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    per_page = current_app.config['MOVIES_PER_PAGE']
+    # 页码过大时 OFFSET 超出 SQLite 整数范围，限制在最后一个可以表示的页码
+    page = min(max(request.args.get('page', 1, type=int), 1), MAX_INTEGER // per_page)
+    movies, has_next = search_movies(q, page, per_page, owner_id(page_owner()))
+    return stream_page('search.html', q=q, movies=movies, page=page, has_next=has_next)
+
+
+@main_bp.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
 @login_required
 def edit(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
+    if request.method == 'GET' and '_flashes' not in session:
+        etag, last_modified = page_validators('edit', movie_id, current_user.get_id())
+        if not_modified(etag, last_modified):
+            return conditional_response('', etag, last_modified, 304)
+        movie = own_movie_or_404(movie_id)
+        return conditional_response(render_template('edit.html', movie=movie), etag, last_modified)
+
+    movie = own_movie_or_404(movie_id)
 
     if request.method == "POST":
         title = request.form['title']
         year = request.form['year']
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        if not validate_movie(title, year):
             flash('Invalid input.')
-            return redirect(url_for('edit', movie_id=movie.id))  # 重定向到编辑页面
+            return redirect(url_for('main.edit', movie_id=movie.id))  # 重定向到编辑页面
 
-        movie.title = title
-        movie.year = year
-        db.session.commit()
+        if run_write(update_movie, current_user.id, movie.id, title, int(year)) == 'duplicate':
+            flash('Movie already in your list.')
+            return redirect(url_for('main.edit', movie_id=movie.id))
         flash('Movie Item Updated.')
-        return redirect(url_for('index'))  # 重定向到主页
+        return redirect(url_for('main.index'))  # 重定向到主页
 
     return render_template('edit.html', movie=movie)  # GET请求时渲染编辑页面，编辑查询出的电影记录
 
 
-@app.route('/movie/delete/<int:movie_id>', methods=['POST'])
+@main_bp.route('/movie/delete/<int:movie_id>', methods=['POST'])
 @login_required  # 添加了这个装饰器后，如果未登录的用户访问对应的URL，Flask-Login会把用户重定向到登录页面，并显示一个错误提示。
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
-    db.session.delete(movie)
-    db.session.commit()
+    movie = own_movie_or_404(movie_id)
+    run_write(delete_movie, current_user.id, movie.id)
     flash('Item Deleted.')
-    return redirect(url_for('index'))
\ No newline at end of file
+    return redirect(url_for('main.index'))
+
+
+def own_movie_or_404(movie_id):
+    """当前用户自己的电影，别人的电影和不存在的一样返回 404"""
+    if movie_id > MAX_INTEGER:  # 绑定到 SQLite 时会溢出
+        abort(404)
+    return Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
+
+
+@main_bp.route('/export.<any(csv, jsonl):fmt>')
+def export(fmt):
+    """流式导出当前清单的全部电影，?gzip=1 时返回 gzip 压缩后的文件"""
+    from watchlist.exporter import export_chunks, mimetypes
+    compress = request.args.get('gzip', type=int) == 1
+    filename = 'movies.' + fmt
+    if compress:
+        filename += '.gz'
+    chunks = export_chunks(fmt, compress=compress, batch_size=current_app.config['EXPORT_BATCH_SIZE'],
+                           user_id=owner_id(page_owner()))
+    response = Response(stream_with_context(chunks), mimetype='application/gzip' if compress else mimetypes[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
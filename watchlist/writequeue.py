@@ -0,0 +1,184 @@
+"""写队列：把表单的添加、修改和删除交给单独的写线程，合并成一个事务提交（group commit）。
+
+不开启时每个写请求各自提交一次事务，SQLite 每次提交都要同步写盘，并且所有写操作串行执行。
+开启 WRITE_QUEUE_ENABLED 后，写线程取出第一个操作后最多再等待 WRITE_QUEUE_BATCH_MS 毫秒，
+把这段时间内排队的操作（最多 WRITE_QUEUE_BATCH_SIZE 个）放在一个事务中执行，每个操作使用一个保存点，
+单个操作失败只回滚它自己，整批只提交一次、只更新一次数据版本号和清除一次页面缓存。
+
+WRITE_QUEUE_ACK 决定请求什么时候返回：commit（默认）等到所在的事务提交之后，queued 放入队列后立即返回。
+queued 模式下开启 WRITE_QUEUE_READ_YOUR_WRITES 时，会话中记录最后一次写操作的序号，
+同一会话之后的请求先等待这个序号提交，用户总能看到自己刚刚做的修改。
+
+写队列在进程内存中，多 worker 部署时每个进程各有一个写线程；queued 模式下进程退出前会提交已经排队的操作，
+但进程被强制结束时排队中的修改会丢失。
+"""
+import atexit
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from functools import partial
+
+from flask import current_app, session
+from werkzeug.exceptions import ServiceUnavailable
+
+from watchlist import app_extension, db
+from watchlist.cache import page_cache
+from watchlist.models import bump_version
+
+_STOP = object()
+
+
+class WriteQueue(object):
+    """单个写线程和它的等待队列，submit() 返回的 Future 在所在的事务提交后完成"""
+
+    def __init__(self, app, batch_ms, batch_size, maxsize):
+        self.app = app
+        self.batch_seconds = batch_ms / 1000.0
+        self.batch_size = batch_size
+        self.token = uuid.uuid4().hex  # 会话中保存的序号只对同一个进程中的同一个队列有效
+        self._queue = queue.Queue(maxsize)
+        self._submit_lock = threading.Lock()
+        self._seq = 0
+        self._done = 0  # 已经提交（或失败）的最大序号
+        self._done_condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args):
+        """把 func(*args) 放入队列，队列已满时抛出 queue.Full"""
+        future = Future()
+        # 序号按入队顺序递增，写线程按同样的顺序执行，提交一批后 _done 之前的操作都已完成
+        with self._submit_lock:
+            self._queue.put_nowait((self._seq + 1, future, func, args))
+            self._seq += 1
+            future.seq = self._seq
+        return future
+
+    def wait(self, seq, timeout=None):
+        """等待序号不大于 seq 的操作全部完成，超时返回 False"""
+        with self._done_condition:
+            return self._done_condition.wait_for(lambda: self._done >= seq, timeout)
+
+    def close(self, timeout=None):
+        """执行完已经排队的操作后结束写线程"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        results = []
+        with self.app.app_context():
+            try:
+                # pysqlite 在第一条 INSERT/UPDATE/DELETE 之前才发出 BEGIN，先更新版本号开始事务，
+                # 否则第一个 SAVEPOINT 会自己开启事务，RELEASE 时就提交了
+                bump_version()
+                for seq, future, func, args in batch:
+                    try:
+                        with db.session.begin_nested():
+                            results.append((future, func(*args), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.exception('Write batch of %d operations failed', len(batch))
+                results = [(future, None, e) for seq, future, func, args in batch]
+            else:
+                page_cache().clear()
+            finally:
+                db.session.remove()
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        with self._done_condition:
+            self._done = batch[-1][0]
+            self._done_condition.notify_all()
+
+
+def start_write_queue(app):
+    """启动写线程，进程退出前关闭写队列"""
+    config = app.config
+    wq = WriteQueue(app, config['WRITE_QUEUE_BATCH_MS'], config['WRITE_QUEUE_BATCH_SIZE'], config['WRITE_QUEUE_MAX'])
+    atexit.register(wq.close, config['WRITE_QUEUE_TIMEOUT'])
+    return wq
+
+
+def write_queue():
+    """返回当前程序的写队列，第一次使用时启动写线程"""
+    return app_extension('write_queue', start_write_queue)
+
+
+def run_write(func, *args):
+    """执行一个写操作，func 在数据库会话中执行修改，不需要自己提交。
+
+    没有开启写队列时在当前请求中执行并提交，返回 func 的返回值；开启后交给写线程，
+    ack 为 commit 时等待提交并返回结果，为 queued 时立即返回 None。队列已满或等待超时时返回 503。
+    """
+    config = current_app.config
+    if not config['WRITE_QUEUE_ENABLED']:
+        result = func(*args)
+        bump_version()
+        db.session.commit()
+        page_cache().clear()
+        return result
+
+    # 先结束请求自己的读事务，回滚日志模式下它持有的共享锁会让写线程无法提交
+    db.session.commit()
+    wq = write_queue()
+    try:
+        future = wq.submit(func, *args)
+    except queue.Full:
+        raise ServiceUnavailable(retry_after=1)
+    if config['WRITE_QUEUE_ACK'] == 'queued':
+        future.add_done_callback(partial(log_failure, current_app.logger))
+        if config['WRITE_QUEUE_READ_YOUR_WRITES']:
+            session['write_seq'] = [wq.token, future.seq]
+        return None
+    try:
+        return future.result(timeout=config['WRITE_QUEUE_TIMEOUT'])
+    except FutureTimeout:  # Python 3.11 之前它和内置的 TimeoutError 不是同一个类
+        raise ServiceUnavailable(retry_after=1)
+
+
+def log_failure(logger, future):
+    error = future.exception()
+    if error is not None:
+        logger.error('Queued write failed: %r', error)
+
+
+def wait_for_own_writes():
+    """before_request 钩子：等待当前会话之前排队的写操作提交"""
+    ticket = session.get('write_seq')
+    if ticket is None:
+        return
+    wq = current_app.extensions.get('write_queue')
+    if wq is None or ticket[0] != wq.token or wq.wait(ticket[1], current_app.config['WRITE_QUEUE_TIMEOUT']):
+        session.pop('write_seq', None)
+
+
+def init_write_queue(app):
+    if app.config['WRITE_QUEUE_ENABLED'] and app.config['WRITE_QUEUE_READ_YOUR_WRITES']:
+        app.before_request(wait_for_own_writes)
@@ -1,4 +1,8 @@
-"""手动设置环境变量并导入程序实例"""
+"""手动设置环境变量并提供程序入口。
+
+web 服务器使用 wsgi:app（或 wsgi:create_web_app()），只加载视图；
+命令行使用 FLASK_APP=wsgi:create_cli_app，只加载命令，不导入视图和模板相关的模块。
+"""
 
 import os
 from dotenv import load_dotenv
@@ -8,4 +12,21 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
-from watchlist import app
+from watchlist import create_app
+
+
+def create_web_app():
+    return create_app(components=('web',))
+
+
+def create_cli_app():
+    return create_app(components=('cli',))
+
+
+def __getattr__(name):
+    # 访问 wsgi.app 时才创建 web 程序，命令行入口导入本模块时不会创建；
+    # flask 命令在没有读取到 FLASK_APP 时（例如 flask --help）也会从本模块查找程序，这时返回完整的程序
+    if name == 'app':
+        app = globals()['app'] = create_app() if os.getenv('FLASK_RUN_FROM_CLI') else create_web_app()
+        return app
+    raise AttributeError(name)